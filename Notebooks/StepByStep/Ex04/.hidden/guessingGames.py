@@ -1,42 +1,161 @@
 import numpy as np
 import time
 
-def guessingGame(nmax=10):
-    print("I am thinking of a number between 1 and {}".format(nmax))
-    target = np.random.randint(1,nmax+1)
+class Player:
+    # Someone (or something) playing guessingGame or higherOrLower. The game calls
+    # start() once, then guess() and feedback() until the target is found, then
+    # finish(). feedback() gets 'low' or 'high' when hints are given, 'wrong'
+    # when they are not. The base class keeps track of the range [lo, hi] the
+    # target can still be in, and of wrong guesses inside it.
+    def start(self,nmax,rng=None):
+        self.lo,self.hi = 1,nmax
+        self.tried = set()
+        self.rng = rng if rng is not None else np.random.default_rng()
+    def guess(self):
+        raise NotImplementedError
+    def feedback(self,guess,result):
+        if result == 'low':
+            self.lo = max(self.lo,guess+1)
+        elif result == 'high':
+            self.hi = min(self.hi,guess-1)
+        elif result == 'wrong':
+            self.tried.add(guess)
+            while self.lo in self.tried:
+                self.lo += 1
+            while self.hi in self.tried:
+                self.hi -= 1
+    def finish(self,count):
+        pass
+    def _untried(self,g):
+        # The closest number to g that could still be the target
+        for d in range(self.hi-self.lo+1):
+            for h in (g-d,g+d):
+                if self.lo <= h <= self.hi and h not in self.tried:
+                    return h
+        raise RuntimeError('No numbers left to guess')
+
+class ConsolePlayer(Player):
+    # A person at the keyboard
+    def start(self,nmax,rng=None):
+        Player.start(self,nmax,rng)
+        print("I am thinking of a number between 1 and {}".format(nmax))
+    def guess(self):
+        while True:
+            try:
+                return int(input("Make a guess:"))
+            except ValueError:
+                print("Please enter an integer.")
+    def feedback(self,guess,result):
+        if result == 'low':
+            print("Too low... try again!")
+        elif result == 'high':
+            print("Too high... try again!")
+        else:
+            print("Sorry, try again.")
+    def finish(self,count):
+        print("Well done! You needed %i guesses."%count)
+
+class BiasedPlayer(Player):
+    # Always guesses a fixed fraction `bias` of the way through the remaining range
+    def __init__(self,bias=0.25):
+        self.bias = bias
+    def split(self,m):
+        # Position (from 1) of the guess in a range of m candidates
+        return 1+int(self.bias*(m-1))
+    def guess(self):
+        return self._untried(self.lo+self.split(self.hi-self.lo+1)-1)
+
+class BinarySearchPlayer(BiasedPlayer):
+    # Always guesses the middle of the remaining range
+    def __init__(self):
+        BiasedPlayer.__init__(self,0.5)
+
+class RandomPlayer(Player):
+    # Guesses uniformly among the numbers that could still be the target
+    def guess(self):
+        while True:
+            g = int(self.rng.integers(self.lo,self.hi+1))
+            if g not in self.tried:
+                return g
+
+def playGame(player,nmax=10,hints=True,rng=None):
+    # Play one game and return the number of guesses needed. Without hints the
+    # player is only told 'wrong'; with hints, 'low' or 'high'.
+    if rng is None:
+        target = np.random.randint(1,nmax+1)
+    else:
+        target = int(rng.integers(1,nmax+1))
+    player.start(nmax,rng)
     count = 1
     while True:
-        try:
-            guess = int(input("Make a guess:"))
-        except ValueError:
-            print("Please enter an integer.")
-            continue
+        guess = player.guess()
         if guess==target:
-            print("Well done! You needed %i guesses."%count)
-            break
+            player.finish(count)
+            return count
+        elif not hints:
+            player.feedback(guess,'wrong')
+        elif guess<target:
+            player.feedback(guess,'low')
         else:
-            count += 1
-            print("Sorry, try again.")
+            player.feedback(guess,'high')
+        count += 1
+
+def guessingGame(nmax=10):
+    playGame(ConsolePlayer(),nmax,hints=False)
                 
         
 def higherOrLower(nmax=10):
-    print("I am thinking of a number between 1 and {}".format(nmax))
-    target = np.random.randint(1,nmax+1)
-    count = 1
-    while True:
-        try:
-            guess = int(input("Make a guess:"))
-        except ValueError:
-            print("Please enter an integer.")
-            continue
-        if guess<target:
-            print("Too low... try again!")
-        elif guess>target:
-            print("Too high... try again!")
-        else:
-            print("Well done! You needed %i guesses."%count)
-            break
-        count +=1
+    playGame(ConsolePlayer(),nmax,hints=True)
+
+def _playMany(args):
+    player,nmax,nGames,hints,seed = args
+    rng = np.random.default_rng(seed)
+    counts = [playGame(player,nmax,hints,rng) for i in range(nGames)]
+    return np.bincount(counts,minlength=nmax+1)
+
+def expectedGuesses(player,nmax,hints=True):
+    # Exact mean number of guesses, where there is a closed form (else None).
+    # Without hints, any player that never repeats a guess needs (nmax+1)/2.
+    # With hints, the total over all targets for a range of m numbers is
+    # T(m) = m + T(left) + T(right), which is summed for m = 1..nmax.
+    if not hints:
+        return (nmax+1)/2.
+    T = np.zeros(nmax+1)
+    if isinstance(player,BiasedPlayer):
+        for m in range(1,nmax+1):
+            g = player.split(m)
+            T[m] = m+T[g-1]+T[m-g]
+    elif isinstance(player,RandomPlayer):
+        # Every split point is equally likely: T(m) = m + (2/m) sum_{k<m} T(k)
+        cumulative = 0.
+        for m in range(1,nmax+1):
+            cumulative += T[m-1]
+            T[m] = m+2*cumulative/m
+    else:
+        return None
+    return float(T[nmax])/nmax
+
+def evaluateStrategy(player,nmaxes=(10,100,1000),nGames=1000000,hints=True,nprocs=None,seed=None,chunkSize=100000):
+    # Have an automated player play nGames games for each nmax, spread over a
+    # process pool with independent random streams. Returns, for each nmax, a
+    # dict with the distribution of guess counts ('counts'[k] = games needing k
+    # guesses), its mean and standard deviation, and the exact expected value
+    # where expectedGuesses knows one.
+    import multiprocessing
+    seeds = np.random.SeedSequence(seed)
+    results = {}
+    with multiprocessing.Pool(nprocs) as pool:
+        for nmax in nmaxes:
+            sizes = [min(chunkSize,nGames-i) for i in range(0,nGames,chunkSize)]
+            jobs = [(player,nmax,n,hints,s) for n,s in zip(sizes,seeds.spawn(len(sizes)))]
+            counts = np.sum(pool.map(_playMany,jobs),axis=0)
+            k = np.arange(counts.shape[0])
+            mean = float(np.sum(k*counts))/nGames
+            results[nmax] = {'counts':counts,
+                             'mean':mean,
+                             'std':float(np.sqrt(np.sum((k-mean)**2*counts)/nGames)),
+                             'expected':expectedGuesses(player,nmax,hints)}
+    return results
 
         
 def montyHall(nBoxes=3):
@@ -63,5 +182,45 @@ def montyHall(nBoxes=3):
         print("\n$$$$$ You won! $$$$$")
     else:
         print("\nSorry! You leave with nothing!")
-            
-    
\ No newline at end of file
+
+
+def _pickExcluding(rng,nBoxes,e1,e2):
+    # Uniform choice of a box (numbered from 0) other than e1 and e2, for whole
+    # arrays at once: draw from the allowed count, then step over the excluded boxes.
+    lo = np.minimum(e1,e2)
+    hi = np.maximum(e1,e2)
+    nAllowed = np.where(lo==hi,nBoxes-1,nBoxes-2)
+    c = (rng.random(lo.shape[0])*nAllowed).astype(int)
+    c += c>=lo
+    c += (c>=hi)&(hi!=lo)
+    return c
+
+def montyHallSimulation(nBoxes=3,nTrials=1000000,strategy='switch',chunkSize=1000000,seed=None,confidence=0.95):
+    # Play montyHall nTrials times with no input, chunkSize games at a time as
+    # whole-array operations. strategy is 'stay' with the first box, 'switch' to
+    # another unopened box, or pick one of the unopened boxes at 'random' (possibly
+    # the first one again). Returns the win rate and its Wilson score interval
+    # at the given confidence level.
+    import math
+    from statistics import NormalDist
+    if nBoxes < 3:
+        raise ValueError('Need at least 3 boxes')
+    if strategy not in ('stay','switch','random'):
+        raise ValueError('Unrecognised strategy')
+    rng = np.random.default_rng(seed)
+    wins = 0
+    for start in range(0,nTrials,chunkSize):
+        m = min(chunkSize,nTrials-start)
+        iCash = rng.integers(0,nBoxes,m)
+        iBox = rng.integers(0,nBoxes,m)
+        iMH = _pickExcluding(rng,nBoxes,iBox,iCash)
+        if strategy == 'switch':
+            iBox = _pickExcluding(rng,nBoxes,iBox,iMH)
+        elif strategy == 'random':
+            iBox = _pickExcluding(rng,nBoxes,iMH,iMH)
+        wins += int(np.count_nonzero(iBox==iCash))
+    p = wins/nTrials
+    z = NormalDist().inv_cdf(0.5+confidence/2)
+    centre = (p+z**2/(2*nTrials))/(1+z**2/nTrials)
+    halfWidth = z*math.sqrt(p*(1-p)/nTrials+z**2/(4*nTrials**2))/(1+z**2/nTrials)
+    return p,(centre-halfWidth,centre+halfWidth)
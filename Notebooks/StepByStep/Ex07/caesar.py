@@ -1,22 +1,71 @@
-def caesar(msg,N):
-    alphabetU = []
-    alphabetL = []
-    for i in range(65, 65+26):
-        alphabetU+=[chr(i)]
-    for i in range(65+32, 65+32+26):
-        alphabetL+=[chr(i)]
-
-    out=''
-    for l in msg:
-        if l==' ': 
-            c=' '
+import numpy as np
+
+UPPER = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+LOWER = 'abcdefghijklmnopqrstuvwxyz'
+
+# Relative frequency (%) of each letter in English text
+ENGLISH = np.array([8.167,1.492,2.782,4.253,12.702,2.228,2.015,6.094,6.966,0.153,0.772,4.025,2.406,
+                    6.749,7.507,1.929,0.095,5.987,6.327,9.056,2.758,0.978,2.360,0.150,1.974,0.074])
+
+_tables = {}
+def _table(N,binary=False):
+    # Translation table shifting letters N places, built once per shift
+    key = (N%26,binary)
+    if key not in _tables:
+        src = UPPER+LOWER
+        dst = UPPER[N%26:]+UPPER[:N%26]+LOWER[N%26:]+LOWER[:N%26]
+        if binary:
+            _tables[key] = bytes.maketrans(src.encode(),dst.encode())
         else:
-            if l.isupper():
-                i = alphabetU.index(l)
-                c = alphabetU[(i+N)%26]
-            else:
-                i = alphabetL.index(l)
-                c = alphabetL[(i+N)%26]
-
-        out+=c
-    return out
\ No newline at end of file
+            _tables[key] = str.maketrans(src,dst)
+    return _tables[key]
+
+def caesar(msg,N):
+    # Shift every letter N places along the alphabet; anything that is not an
+    # ASCII letter (spaces, punctuation, digits...) is passed through unchanged.
+    # Works on str or bytes.
+    return msg.translate(_table(N,isinstance(msg,(bytes,bytearray))))
+
+def caesarFile(infile,outfile,N,chunkSize=1<<24):
+    # Encode (or, with -N, decode) a file of any size, chunkSize bytes at a time.
+    # Only ASCII letters are touched, so UTF-8 text passes through intact.
+    table = _table(N,binary=True)
+    with open(infile,'rb') as fin, open(outfile,'wb') as fout:
+        while True:
+            chunk = fin.read(chunkSize)
+            if not chunk:
+                break
+            fout.write(chunk.translate(table))
+
+def letterHistogram(msg):
+    # Counts of each letter A-Z in msg (str or bytes), ignoring case
+    if isinstance(msg,str):
+        msg = msg.encode('ascii','ignore')
+    b = np.frombuffer(msg,dtype=np.uint8)
+    b = (b|0x20)-ord('a')   # fold case; letters become 0-25
+    return np.bincount(b[b<26],minlength=26)
+
+def crackScores(hist):
+    # Chi-squared distance from English of the text decoded with every shift
+    # 0-25, from its letter histogram. All shifts are scored at once:
+    # row N of the index matrix rolls the histogram back by N.
+    hist = np.asarray(hist,dtype=float)
+    rolled = hist[(np.arange(26)[:,None]+np.arange(26)[None,:])%26]
+    expected = hist.sum()*ENGLISH/ENGLISH.sum()
+    return np.sum((rolled-expected)**2/expected,axis=1)
+
+def crackCaesar(msg):
+    # The most likely N used to encode msg, and msg decoded with it
+    N = int(np.argmin(crackScores(letterHistogram(msg))))
+    return N,caesar(msg,-N)
+
+def crackCaesarFile(infile,chunkSize=1<<24):
+    # The most likely N used to encode a file, streaming it through letterHistogram
+    hist = np.zeros(26,dtype=np.int64)
+    with open(infile,'rb') as fin:
+        while True:
+            chunk = fin.read(chunkSize)
+            if not chunk:
+                break
+            hist += letterHistogram(chunk)
+    return int(np.argmin(crackScores(hist)))
@@ -14,4 +14,49 @@ def rotation_list(rots):
     R = np.eye(3)
     for ax,ang in rots:
         R = rotation_about(ax,ang).dot(R)
-    return R
\ No newline at end of file
+    return R
+def rotation_matrices(axes,angles):
+    # Stack of rotation_about(axes[k],angles[k]) matrices, shape angles.shape+(3,3).
+    # axes is an array of 'x', 'y' and 'z' (or a single letter for all).
+    axes = np.asarray(axes)
+    angles = np.asarray(angles,dtype=float)
+    axes = np.broadcast_to(axes,angles.shape)
+    if not np.all(np.isin(axes,['x','y','z'])):
+        raise ValueError('Unrecognised axis')
+    cth = np.cos(np.deg2rad(angles))
+    sth = np.sin(np.deg2rad(angles))
+    R = np.zeros(angles.shape+(3,3))
+    # Same sign convention as rotation_about: R[i,j] = -sin, R[j,i] = +sin
+    for ax,(i,j) in (('x',(1,2)),('y',(0,2)),('z',(0,1))):
+        m = axes==ax
+        k = 3-i-j
+        R[m,k,k] = 1
+        R[m,i,i] = cth[m]
+        R[m,j,j] = cth[m]
+        R[m,i,j] = -sth[m]
+        R[m,j,i] = sth[m]
+    return R
+
+def compose_rotations(axes,angles):
+    # rotation_list for many sites at once. axes and angles have shape
+    # (nsites, nsteps), each row being one sequence of rotations (first
+    # rotation first). Returns (nsites,3,3); the loop is over steps only.
+    Rs = rotation_matrices(axes,angles)
+    R = np.broadcast_to(np.eye(3),Rs.shape[:-3]+(3,3)).copy()
+    for k in range(Rs.shape[-3]):
+        R = np.matmul(Rs[...,k,:,:],R)
+    return R
+
+def apply_rotations(R,points,sites=None,chunk=65536):
+    # Rotate an (N,3) array of points in place and return it. R is a single
+    # (3,3) matrix, or a stack (nsites,3,3) with sites[n] giving the matrix for
+    # point n. Points are done chunk at a time, so only chunk matrices are ever
+    # gathered at once, whatever the size of the point cloud.
+    R = np.asarray(R)
+    for start in range(0,points.shape[0],chunk):
+        p = points[start:start+chunk]
+        if R.ndim == 2:
+            p[:] = p @ R.T
+        else:
+            p[:] = np.einsum('nij,nj->ni',R[sites[start:start+chunk]],p)
+    return points
@@ -1,36 +1,282 @@
+import time
 import numpy as np
 
-def sudoku_solver(sudoku):
-    changes = True
-    while changes:
-        changes = False
-        for i in range(9):
-            for j in range(9):
-                if sudoku[i,j]==0:
-                    cand = np.arange(1,10,dtype='int').tolist() 
-                    for k in range(0,9):
-                        if sudoku[k,j]==0: continue
-                        try:
-                            cand.remove(sudoku[k,j])
-                        except ValueError:
-                            continue
-                    for k in range(0,9):
-                        if sudoku[i,k]==0: continue
-                        try:
-                            cand.remove(sudoku[i,k])
-                        except ValueError:
-                            continue
-                    i3 = 3*int(i/3)
-                    j3 = 3*int(j/3)
-                    print(i3,j3)
-                    for k in range(i3,i3+3):
-                        for l in range(j3,j3+3):
-                            if sudoku[k,l]==0: continue
-                            try:
-                                cand.remove(sudoku[k,l])
-                            except ValueError:
-                                continue
-                    if len(cand)==1: 
-                        sudoku[i,j] = cand[0]
-                        changes = True
+# Candidates are 9-bit masks: bit d-1 set means digit d is possible.
+_FULL = 0x1FF
+_ROW = [c//9 for c in range(81)]
+_COL = [c%9 for c in range(81)]
+_BOX = [3*(c//27)+(c%9)//3 for c in range(81)]
+_UNITS = ([[9*r+k for k in range(9)] for r in range(9)] +
+          [[9*k+c for k in range(9)] for c in range(9)] +
+          [[9*(3*(b//3)+k//3)+3*(b%3)+k%3 for k in range(9)] for b in range(9)])
+_POPCOUNT = [bin(m).count('1') for m in range(512)]
+_DIGIT = {1<<(d-1):d for d in range(1,10)}
+
+# Hooks for instrumentation.Recorder: sudoku_solver reports its guesses and
+# propagation passes to each callable here
+CALLBACKS = []
+
+def _report(function,start,**counts):
+    record = dict(function=function,calls=1,time=time.perf_counter()-start,**counts)
+    for callback in CALLBACKS:
+        callback(record)
+
+class BitmaskSudoku:
+    # A grid together with the digits already used in each row, column and box,
+    # kept as bitmasks and updated incrementally as digits are placed and removed.
+    # Every placement is pushed onto a trail so that guesses can be undone.
+    def __init__(self,sudoku):
+        self.cells = [int(v) for v in np.asarray(sudoku).ravel()]
+        if len(self.cells) != 81:
+            raise ValueError('Sudoku must be 9 x 9')
+        self.rows = [0]*9
+        self.cols = [0]*9
+        self.boxes = [0]*9
+        self.trail = []
+        self.passes = 0
+        self.guesses = 0
+        for c,d in enumerate(self.cells):
+            if d == 0:
+                continue
+            bit = 1<<(d-1)
+            if (self.rows[_ROW[c]]|self.cols[_COL[c]]|self.boxes[_BOX[c]]) & bit:
+                raise ValueError('Digit %i repeated at row %i, column %i'%(d,_ROW[c],_COL[c]))
+            self.rows[_ROW[c]] |= bit
+            self.cols[_COL[c]] |= bit
+            self.boxes[_BOX[c]] |= bit
+
+    def candidates(self,c):
+        return _FULL & ~(self.rows[_ROW[c]]|self.cols[_COL[c]]|self.boxes[_BOX[c]])
+
+    def place(self,c,bit):
+        self.cells[c] = _DIGIT[bit]
+        self.rows[_ROW[c]] |= bit
+        self.cols[_COL[c]] |= bit
+        self.boxes[_BOX[c]] |= bit
+        self.trail.append(c)
+
+    def undo(self,mark):
+        # Remove every digit placed since the trail was mark long
+        while len(self.trail) > mark:
+            c = self.trail.pop()
+            bit = 1<<(self.cells[c]-1)
+            self.cells[c] = 0
+            self.rows[_ROW[c]] &= ~bit
+            self.cols[_COL[c]] &= ~bit
+            self.boxes[_BOX[c]] &= ~bit
+
+    def propagate(self):
+        # Fill in naked singles (cells with one candidate) and hidden singles
+        # (digits with one possible cell in a row, column or box) until nothing
+        # changes. Returns False if the grid turns out to be impossible.
+        changed = True
+        while changed:
+            changed = False
+            self.passes += 1
+            for c in range(81):
+                if self.cells[c] == 0:
+                    m = self.candidates(c)
+                    if m == 0:
+                        return False
+                    if m & (m-1) == 0:
+                        self.place(c,m)
+                        changed = True
+            for unit in _UNITS:
+                once = twice = placed = 0
+                for c in unit:
+                    if self.cells[c] == 0:
+                        m = self.candidates(c)
+                        twice |= once & m
+                        once |= m
+                    else:
+                        placed |= 1<<(self.cells[c]-1)
+                if once|placed != _FULL:
+                    return False
+                singles = once & ~twice & ~placed
+                while singles:
+                    bit = singles & -singles
+                    singles ^= bit
+                    for c in unit:
+                        if self.cells[c] == 0 and self.candidates(c) & bit:
+                            self.place(c,bit)
+                            changed = True
+                            break
+                    else:
+                        return False
+        return True
+
+    def branches(self):
+        # The choices to guess between next: the candidates of the cell with
+        # the fewest, unless some digit has only two places left in a unit,
+        # which splits the search just as well and avoids the long dead ends
+        # cell-only branching runs into on sparse puzzles. Returns None when
+        # the grid is full.
+        best,bestCount = -1,10
+        for c in range(81):
+            if self.cells[c] == 0:
+                n = _POPCOUNT[self.candidates(c)]
+                if n < bestCount:
+                    best,bestCount = c,n
+                    if n == 2:
+                        break
+        if best < 0:
+            return None
+        if bestCount > 2:
+            for unit in _UNITS:
+                free = [c for c in unit if self.cells[c] == 0]
+                masks = [self.candidates(c) for c in free]
+                once = twice = thrice = 0
+                for m in masks:
+                    thrice |= twice & m
+                    twice |= once & m
+                    once |= m
+                pairs = twice & ~thrice
+                if pairs:
+                    bit = pairs & -pairs
+                    return [(c,bit) for c,m in zip(free,masks) if m & bit]
+        m = self.candidates(best)
+        choices = []
+        while m:
+            bit = m & -m
+            m ^= bit
+            choices.append((best,bit))
+        return choices
+
+    def solve(self):
+        # Propagate, then guess between the fewest choices and recurse
+        if not self.propagate():
+            return False
+        choices = self.branches()
+        if choices is None:
+            return True
+        mark = len(self.trail)
+        for c,bit in choices:
+            self.guesses += 1
+            self.place(c,bit)
+            if self.solve():
+                return True
+            self.undo(mark)
+        return False
+
+def sudoku_solver(sudoku,search=True):
+    # Solve a 9x9 array in place (0 for empty cells) and return it.
+    # With search=False only constraint propagation is used, so cells may be
+    # left at 0; otherwise any valid puzzle is solved completely. Raises
+    # ValueError if the puzzle has no solution.
+    start = time.perf_counter()
+    state = BitmaskSudoku(sudoku)
+    ok = state.solve() if search else state.propagate()
+    if CALLBACKS:
+        _report('sudoku_solver',start,evaluations=state.guesses,iterations=state.passes)
+    if not ok:
+        raise ValueError('Sudoku has no solution')
+    sudoku[...] = np.array(state.cells).reshape(9,9)
     return sudoku
+
+SOLVE_RESULT = np.dtype([('solved','?'),('searched','?'),('time','f8')])
+
+# Lookup tables for the array version: the units as an index array, where
+# each cell sits in the flattened (27*9) unit layout, and per-mask popcounts
+# and digits (0 where the mask is not a single bit)
+_UNIT_INDEX = np.array(_UNITS)
+_CELL_SLOTS = np.array([[9*u+k for u,unit in enumerate(_UNITS) for k,c in enumerate(unit) if c == cell]
+                        for cell in range(81)])
+_POPCOUNT_ARRAY = np.array(_POPCOUNT,dtype=np.int8)
+_DIGIT_ARRAY = np.zeros(512,dtype=np.int8)
+for _bit,_d in _DIGIT.items():
+    _DIGIT_ARRAY[_bit] = _d
+
+def _propagateBatch(grids):
+    # Naked and hidden singles for a whole (N,81) stack of grids at once, in
+    # place, using the same 9-bit candidate masks as BitmaskSudoku. Returns a
+    # boolean array marking the puzzles found to be contradictory; those are
+    # left as they were when the contradiction appeared.
+    n = grids.shape[0]
+    dead = np.zeros(n,dtype=bool)
+    active = np.arange(n)
+    while active.size:
+        g = grids[active]
+        empty = g == 0
+        bits = np.where(empty,0,np.left_shift(1,np.maximum(g,1).astype(np.uint16)-1)).astype(np.uint16)
+        unitBits = bits[:,_UNIT_INDEX]
+        used = np.bitwise_or.reduce(unitBits,axis=2)
+        bad = (_POPCOUNT_ARRAY[used] != (unitBits != 0).sum(axis=2)).any(axis=1)
+        cand = _FULL & ~np.bitwise_or.reduce(used[:,_CELL_SLOTS//9],axis=2)
+        cand[~empty] = 0
+        bad |= (empty & (cand == 0)).any(axis=1)
+        # Digits seen once and more than once among each unit's candidates
+        unitCand = cand[:,_UNIT_INDEX]
+        once = np.zeros_like(used)
+        twice = np.zeros_like(used)
+        for k in range(9):
+            twice |= once & unitCand[:,:,k]
+            once |= unitCand[:,:,k]
+        bad |= ((once|used) != _FULL).any(axis=1)
+        # Each cell takes its single candidate or the digit it alone can hold
+        # in one of its units; claiming two digits is a contradiction.
+        hidden = (unitCand & (once & ~twice)[:,:,None]).reshape(-1,27*9)
+        assign = np.where(_POPCOUNT_ARRAY[cand] == 1,cand,0)
+        assign |= np.bitwise_or.reduce(hidden[:,_CELL_SLOTS],axis=2)
+        bad |= (_POPCOUNT_ARRAY[assign] > 1).any(axis=1)
+        found = assign != 0
+        g[found] = _DIGIT_ARRAY[assign[found]]
+        progress = found.any(axis=1) & ~bad
+        grids[active[progress]] = g[progress]
+        dead[active[bad]] = True
+        active = active[progress]
+    return dead
+
+def _solveSearch(sudoku):
+    # Pool worker: solve one grid by search; returns (grid, solved, seconds)
+    start = time.perf_counter()
+    try:
+        sudoku_solver(sudoku)
+        ok = True
+    except ValueError:
+        ok = False
+    return sudoku,ok,time.perf_counter()-start
+
+def sudoku_solver_batch(sudokus,nprocs=None,chunkSize=65536):
+    # Solve an (N,9,9) stack of puzzles in place and return a structured array
+    # (see SOLVE_RESULT) with one record per puzzle. Propagation runs on whole
+    # chunks of the stack as array operations; only puzzles it cannot finish
+    # are searched, one at a time across a process pool. 'time' is the
+    # chunk's propagation time shared equally between its puzzles, plus the
+    # search time for those that needed it. Unsolvable puzzles are reported
+    # with solved=False and left partially filled.
+    import multiprocessing
+    sudokus = np.asarray(sudokus)
+    if sudokus.ndim != 3 or sudokus.shape[1:] != (9,9):
+        raise ValueError('Expected an (N, 9, 9) array of puzzles')
+    out = np.zeros(sudokus.shape[0],dtype=SOLVE_RESULT)
+    pool = None
+    try:
+        for i in range(0,sudokus.shape[0],chunkSize):
+            chunk = sudokus[i:i+chunkSize]
+            start = time.perf_counter()
+            grids = chunk.reshape(-1,81).astype(np.int8)
+            dead = _propagateBatch(grids)
+            res = out[i:i+chunk.shape[0]]
+            res['time'] = (time.perf_counter()-start)/chunk.shape[0]
+            res['solved'] = ~dead & (grids != 0).all(axis=1)
+            # Contradictory puzzles are searched too, starting from the
+            # original grid, so that they are reported by the same route.
+            grids[dead] = chunk[dead].reshape(-1,81)
+            todo = np.flatnonzero(~res['solved'])
+            if todo.size:
+                res['searched'][todo] = True
+                if pool is None and todo.size > 1 and nprocs != 1:
+                    pool = multiprocessing.Pool(nprocs)
+                puzzles = grids[todo].reshape(-1,9,9)
+                results = (pool.imap(_solveSearch,puzzles,chunksize=16)
+                           if pool is not None else map(_solveSearch,puzzles))
+                for k,(g,ok,dt) in zip(todo,results):
+                    grids[k] = g.ravel()
+                    res['solved'][k] = ok
+                    res['time'][k] += dt
+            chunk[...] = grids.reshape(-1,9,9)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return out
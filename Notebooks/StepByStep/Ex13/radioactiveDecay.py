@@ -1,7 +1,103 @@
 import numpy as np
-import matplotlib.pyplot as plt
 
-def simulateDecay(tstep, nTimestep, n0=10000):
+# Each row: isotope, half-life (s), energy released per decay (MeV), and the
+# fraction of decays going to each daughter. Daughters without a row are stable.
+RN219_CHAIN = [('Rn', 3.96, 6.946+7.527, {'Pb211':1.}),
+               ('Pb211', 36.1 * 60, 1.367, {'Bi':1.}),
+               ('Bi', 2.14 * 60, 6.751, {'Tl':1.}),
+               ('Tl', 4.77 * 60, 1.418, {'Pb':1.})]
+
+def decayMatrix(chain):
+    """
+    Build the rate matrix of a decay chain.
+
+    Parameters
+    ----------
+    chain : list
+        Rows of (isotope, half-life, energy per decay, {daughter: branching fraction}).
+
+    Returns
+    -------
+    list : Names of all isotopes, including stable daughters.
+    array-like : Rate matrix A, such that dn/dt = A n.
+    array-like : Decay constant of each isotope (0 if stable).
+    array-like : Energy released per decay of each isotope.
+    """
+    names = [row[0] for row in chain]
+    for row in chain:
+        for daughter in row[3]:
+            if daughter not in names:
+                names.append(daughter)
+    index = {name:i for i, name in enumerate(names)}
+    decayRate = np.zeros(len(names))
+    energyRelease = np.zeros(len(names))
+    A = np.zeros((len(names), len(names)))
+    for name, tHalf, energy, daughters in chain:
+        i = index[name]
+        decayRate[i] = np.log(2)/tHalf
+        energyRelease[i] = energy
+        A[i, i] -= decayRate[i]
+        for daughter, fraction in daughters.items():
+            A[index[daughter], i] += fraction * decayRate[i]
+    return names, A, decayRate, energyRelease
+
+def solveDecayChain(time, n0=10000, chain=RN219_CHAIN):
+    """
+    Exact concentrations in a decay chain at any set of times.
+
+    The chain is solved through the eigen-decomposition of its rate matrix
+    (equivalent to the Bateman equations), so all times are evaluated at once
+    and no time stepping is involved. If the decomposition is ill-conditioned
+    (e.g. two isotopes with the same half-life) the matrix exponential is used
+    instead.
+
+    Parameters
+    ----------
+    time : array-like
+        Times at which to evaluate the solution.
+    n0 : float or dict
+        The initial concentration of the first isotope in the chain, or a dict
+        of initial concentrations by isotope.
+    chain : list
+        Rows of (isotope, half-life, energy per decay, {daughter: branching fraction}).
+
+    Returns
+    -------
+    dict : The concentration of each isotope at each time.
+    array-like : The total energy released between time 0 and each time.
+    """
+    names, A, decayRate, energyRelease = decayMatrix(chain)
+    time = np.asarray(time, dtype=float)
+    N0 = np.zeros(len(names))
+    if isinstance(n0, dict):
+        for name, value in n0.items():
+            N0[names.index(name)] = value
+    else:
+        N0[0] = n0
+    lam, V = np.linalg.eig(A)
+    if np.linalg.cond(V) < 1e10:
+        lam = np.real(lam)
+        V = np.real(V)
+        c = np.linalg.solve(V, N0)
+        lt = np.outer(time, lam)
+        n = (np.exp(lt) * c) @ V.T
+        # Time integral of each mode, for the number of decays so far
+        with np.errstate(divide='ignore', invalid='ignore'):
+            integral = np.where(lam != 0, np.expm1(lt) / lam, time[:, None])
+        nIntegral = (integral * c) @ V.T
+    else:
+        from scipy.linalg import expm
+        # Augmented system d/dt [n, q] = [A n, n] carries the integral q of n along
+        nn = len(names)
+        B = np.zeros((2*nn, 2*nn))
+        B[:nn, :nn] = A
+        B[nn:, :nn] = np.eye(nn)
+        z = expm(time[:, None, None] * B) @ np.concatenate((N0, np.zeros(nn)))
+        n, nIntegral = z[:, :nn], z[:, nn:]
+    energy = nIntegral @ (decayRate * energyRelease)
+    return {name:n[:, i] for i, name in enumerate(names)}, energy
+
+def simulateDecay(tstep, nTimestep, n0=10000, method='exact'):
     """
     Simulate the radioactive decay of 219Rn into its daughter isotopes.
 
@@ -13,13 +109,24 @@ def simulateDecay(tstep, nTimestep, n0=10000):
         The number of simulation steps.
     n0 : float
         The initial concentration of 219Rn
+    method : str
+        'exact' to evaluate the analytic solution at every step (see
+        solveDecayChain), or 'euler' for explicit Euler time stepping.
 
     Returns
     -------
     array-like : Time scale of decay.
     dict : The concentrations 219Rn and each daughter isotope.
-    array-like : The total energy released by the decay reaction.
+    array-like : The energy released by the decay reaction during each step.
     """
+    if method == 'exact':
+        time = np.arange(nTimestep) * tstep
+        n, cumulativeEnergy = solveDecayChain(time, n0)
+        energy = np.zeros(nTimestep)
+        energy[1:] = np.diff(cumulativeEnergy)
+        return time, n, energy
+    elif method != 'euler':
+        raise ValueError('Unrecognised method')
     halfLife = {'Rn':3.96, 'Pb211':36.1 * 60, 'Bi':2.14 * 60, 'Tl':4.77 * 60}
     energyRelease = {'Rn':6.946+7.527, 'Pb211':1.367, 'Bi':6.751, 'Tl':1.418}
     decayRate = {}
@@ -50,6 +157,141 @@ def simulateDecay(tstep, nTimestep, n0=10000):
         n['Pb'][i+1] = n['Pb'][i] + Tl2Pb
     return time, n, energy
 
+def _decayEnsembleChunk(args):
+    # Advance nMembers independent copies of the chain with binomial draws and
+    # return running sums, sums of squares and histograms of each population
+    tstep, nTimestep, N0, chain, nMembers, nbins, width, seed = args
+    names, A, decayRate, energyRelease = decayMatrix(chain)
+    index = {name:i for i, name in enumerate(names)}
+    rng = np.random.default_rng(seed)
+    pDecay = -np.expm1(-decayRate * tstep)
+    n = np.tile(N0, (nMembers, 1))
+    total = np.zeros((nTimestep, len(names)))
+    totalSq = np.zeros((nTimestep, len(names)))
+    hist = np.zeros((nTimestep, len(names), nbins), dtype=np.int32)
+    energyTotal = np.zeros(nTimestep)
+    energyTotalSq = np.zeros(nTimestep)
+    def record(i, energy):
+        total[i] = n.sum(axis=0)
+        totalSq[i] = (n.astype(float)**2).sum(axis=0)
+        for j in range(len(names)):
+            hist[i, j] = np.bincount(np.minimum(n[:, j] // width, nbins-1), minlength=nbins)
+        energyTotal[i] = energy.sum()
+        energyTotalSq[i] = (energy**2).sum()
+    record(0, np.zeros(nMembers))
+    for i in range(1, nTimestep):
+        # Atoms decaying this step are drawn from the populations at the start of the step
+        decays = rng.binomial(n, pDecay)
+        energy = decays @ energyRelease
+        n -= decays
+        for name, tHalf, e, daughters in chain:
+            remaining = decays[:, index[name]]
+            left = 1.
+            for daughter, fraction in daughters.items():
+                x = rng.binomial(remaining, min(fraction/left, 1.))
+                n[:, index[daughter]] += x
+                remaining = remaining - x
+                left -= fraction
+        record(i, energy)
+    return total, totalSq, hist, energyTotal, energyTotalSq
+
+def simulateDecayEnsemble(tstep, nTimestep, n0=10000, nMembers=1000, chain=RN219_CHAIN,
+                          quantiles=(0.05, 0.5, 0.95), nbins=256, chunkSize=1000, nprocs=None, seed=None):
+    """
+    Simulate the decay of a chain atom by atom, for many independent samples.
+
+    Every step, the number of atoms of each isotope that decay is drawn from a
+    binomial distribution, so the spread between ensemble members shows the
+    counting statistics of small samples. Members are simulated chunkSize at a
+    time as 2-D arrays, with chunks spread across a process pool and given
+    independent random streams. Only summary statistics are kept: the
+    histories of individual members are never stored.
+
+    Parameters
+    ----------
+    tstep : float
+        Time between simulation steps.
+    nTimestep : int
+        The number of simulation steps.
+    n0 : int or dict
+        The initial number of atoms of the first isotope in the chain, or a dict
+        of initial numbers by isotope.
+    nMembers : int
+        The number of ensemble members.
+    chain : list
+        Rows of (isotope, half-life, energy per decay, {daughter: branching fraction}).
+    quantiles : tuple
+        The quantiles to compute at each time.
+    nbins : int
+        Populations are histogrammed in at most nbins bins to find quantiles;
+        these are exact whenever the largest population is below nbins.
+    chunkSize : int
+        The number of members simulated together in one process.
+    nprocs : int or None
+        The number of worker processes (default: all cores).
+    seed : int or None
+        Seed for the random number generators.
+
+    Returns
+    -------
+    array-like : Time scale of decay.
+    dict : 'mean' and 'var' (dicts of arrays by isotope, like simulateDecay),
+        'quantiles' (dict of (len(quantiles), nTimestep) arrays by isotope), and
+        'energyMean' and 'energyVar' of the energy released during each step.
+    """
+    import multiprocessing
+    names, A, decayRate, energyRelease = decayMatrix(chain)
+    N0 = np.zeros(len(names), dtype=np.int64)
+    if isinstance(n0, dict):
+        for name, value in n0.items():
+            N0[names.index(name)] = value
+    else:
+        N0[0] = n0
+    # Populations never exceed the total number of atoms
+    width = max(1, int(np.ceil((N0.sum()+1)/nbins)))
+    nbins = int((N0.sum()+1 + width-1) // width)
+    sizes = [min(chunkSize, nMembers-i) for i in range(0, nMembers, chunkSize)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    jobs = [(tstep, nTimestep, N0, chain, m, nbins, width, sd) for m, sd in zip(sizes, seeds)]
+    # Each chunk's sums and histograms are added in as soon as it finishes,
+    # so memory does not grow with the number of chunks
+    totals = None
+    pool = multiprocessing.Pool(nprocs) if len(jobs) > 1 else None
+    try:
+        results = (pool.imap_unordered(_decayEnsembleChunk, jobs) if pool is not None
+                   else map(_decayEnsembleChunk, jobs))
+        for r in results:
+            if totals is None:
+                totals = list(r)
+            else:
+                for k in range(5):
+                    totals[k] += r[k]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    total, totalSq, hist, energyTotal, energyTotalSq = totals
+    mean = total / nMembers
+    var = totalSq / nMembers - mean**2
+    # Quantiles from the cumulative histograms, interpolating within a bin if bins are wider than 1
+    cdf = np.cumsum(hist, axis=-1)
+    q = np.zeros((len(quantiles), nTimestep, len(names)))
+    for k, quantile in enumerate(quantiles):
+        target = quantile * nMembers
+        b = np.argmax(cdf >= target, axis=-1)
+        if width == 1:
+            q[k] = b
+        else:
+            below = np.take_along_axis(cdf, b[..., None], -1)[..., 0] - np.take_along_axis(hist, b[..., None], -1)[..., 0]
+            inBin = np.take_along_axis(hist, b[..., None], -1)[..., 0]
+            q[k] = width * (b + (target - below) / np.maximum(inBin, 1))
+    stats = {'mean':{name:mean[:, i] for i, name in enumerate(names)},
+             'var':{name:np.maximum(var[:, i], 0) for i, name in enumerate(names)},
+             'quantiles':{name:q[:, :, i] for i, name in enumerate(names)},
+             'energyMean':energyTotal / nMembers,
+             'energyVar':np.maximum(energyTotalSq / nMembers - (energyTotal / nMembers)**2, 0)}
+    return np.arange(nTimestep) * tstep, stats
+
 def plotDecay(time, n, figsize=(10, 8)):
     """
     Plot the decay of all isotopes against time.
@@ -67,6 +309,7 @@ def plotDecay(time, n, figsize=(10, 8)):
     -------
     None
     """
+    import matplotlib.pyplot as plt
     plt.figure(figsize=figsize)
     plt.plot(time, n['Rn'], label='${}^{219}$Rn')
     plt.plot(time, n['Pb211'], label='${}^{211}$Pb')
@@ -97,6 +340,7 @@ def plotEnergy(time, e, figsize=(10, 8)):
     -------
     None
     """
+    import matplotlib.pyplot as plt
     plt.figure(figsize=figsize)
     plt.plot(time, e)
     plt.legend()
@@ -106,6 +350,57 @@ def plotEnergy(time, e, figsize=(10, 8)):
     plt.yscale('log')
     plt.show()
 
+def pb211RatioCurve(time, n):
+    """
+    The 211Pb/207Pb ratio as a function of time, ready for age inversion.
+
+    Parameters
+    ----------
+    time : array-like
+        The times of the simulation.
+    n : dict
+        A dictionary containing all calculated isotopes.
+
+    Returns
+    -------
+    array-like : The times at which 207Pb is present.
+    array-like : The ratio at those times, made non-increasing (each value is
+        the lowest ratio reached so far, which is what matters for the first
+        time the ratio falls below a given value).
+    """
+    valid = n['Pb'] > 0
+    return time[valid], np.minimum.accumulate(n['Pb211'][valid] / n['Pb'][valid])
+
+def calculateAges(curve, Pb211ratio):
+    """
+    Ages at which the 211Pb/207Pb ratio first falls to each measured value.
+
+    Parameters
+    ----------
+    curve : tuple
+        The (time, ratio) curve returned by pb211RatioCurve.
+    Pb211ratio : float or array-like
+        The measured ratio(s).
+
+    Returns
+    -------
+    array-like : The age for each ratio, interpolated linearly between time
+        steps. NaN where the ratio is outside the range of the curve.
+    """
+    t, r = curve
+    # searchsorted needs ascending values, so work from the end of the curve
+    rev = r[::-1]
+    trev = t[::-1]
+    q = np.asarray(Pb211ratio, dtype=float)
+    if rev.shape[0] < 2:
+        return np.full(q.shape, np.nan)
+    j = np.searchsorted(rev, q, side='left')
+    inRange = (j > 0) & (j < rev.shape[0])
+    j = np.clip(j, 1, rev.shape[0] - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        age = trev[j-1] + (q - rev[j-1]) * (trev[j] - trev[j-1]) / (rev[j] - rev[j-1])
+    return np.where(inRange, age, np.nan)
+
 def calculateAge(time, n, Pb211ratio):
     """
     Calculate the age of a reaction based the Pb211
@@ -116,16 +411,17 @@ def calculateAge(time, n, Pb211ratio):
         The time axis for the plot.
     n : dict
         A dictionary containing all calculated isotopes.
-    figsize : tuple
-        The size of the figure to be produced (in inches).
+    Pb211ratio : float
+        The measured 211Pb/207Pb ratio.
 
     Returns
     -------
-    None
+    float : The age, which is also printed as hours:minutes:seconds. NaN
+        (with a message) if the ratio is never reached in the simulation.
     """
-    nTimestep = time.size
-    for i in range(0, nTimestep):
-        if n['Pb'][i] > 0:
-            if n['Pb211'][i] / n['Pb'][i] < Pb211ratio:
-                break
-    print("%i:%i:%04.1f"%(int(time[i] // 3600), int(time[i] % 3600) // 60, (time[i] % 3600) % 60))
\ No newline at end of file
+    age = float(calculateAges(pb211RatioCurve(time, n), Pb211ratio))
+    if np.isnan(age):
+        print("Ratio %g is outside the range of the simulation" % Pb211ratio)
+        return age
+    print("%i:%i:%04.1f"%(int(age // 3600), int(age % 3600) // 60, (age % 3600) % 60))
+    return age
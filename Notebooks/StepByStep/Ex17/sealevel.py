@@ -1,9 +1,64 @@
-import pandas as pd
+import os
+from collections import OrderedDict
 import numpy as np
-import matplotlib.pyplot as plt
+
+class RSLData:
+    # The columns of an RSL workbook as numpy arrays, available either as
+    # data.Age_kaBP or as data['Age_kaBP'] (like the DataFrame it came from)
+    def __init__(self,columns):
+        self.columns = columns
+    def __getattr__(self,name):
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError:
+            raise AttributeError(name)
+    def __getitem__(self,name):
+        return self.columns[name]
+
+CACHE_SIZE = 8
+_cache = OrderedDict()
+
+def load_data(filename,sidecar=True):
+    # Read an RSL workbook, parsing the Excel file only when we have to.
+    # Parsed data are kept in memory (the CACHE_SIZE most recently used files)
+    # and, if sidecar is True, saved next to the workbook as <filename>.npz so
+    # that other processes can skip Excel too. Both are keyed on the workbook's
+    # modification time, so editing the workbook invalidates them.
+    path = os.path.abspath(filename)
+    mtime = os.path.getmtime(path)
+    key = (path,mtime)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+    sidecarFile = path+'.npz'
+    columns = None
+    if sidecar and os.path.exists(sidecarFile):
+        with np.load(sidecarFile) as f:
+            if f['_mtime'] == mtime:
+                columns = {k:f[k] for k in f.files if k != '_mtime'}
+    if columns is None:
+        import pandas as pd
+        frame = pd.read_excel(path)
+        columns = {str(c):frame[c].to_numpy() for c in frame.columns}
+        if sidecar and not any(c.dtype == object for c in columns.values()):
+            try:
+                # Write then rename, so no other process ever sees half a file
+                tmp = sidecarFile+'.%i.tmp'%os.getpid()
+                with open(tmp,'wb') as fp:
+                    np.savez(fp,_mtime=mtime,**columns)
+                os.replace(tmp,sidecarFile)
+            except OSError:
+                pass
+    data = RSLData(columns)
+    _cache[key] = data
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return data
 
 def load_and_plot_data(filename,figsize=(12,6)):
-    data = pd.read_excel(filename)
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    data = pd.DataFrame(load_data(filename).columns)
     plt.figure(figsize=figsize)
     plt.plot(data['Age_kaBP'],data['RSL_m'],color='firebrick')
     plt.xlabel("Age (kaBP)")
@@ -19,15 +74,12 @@ def interpolate_data(data,ninterp=4096):
 def de_mean(u):
     return u-u.mean()
 
-def plot_Milankovitch(filename,nfft=40960,figsize=(10,8)):
-    data = pd.read_excel(filename)
-    interpTimes, interpData = interpolate_data(data)
-
-    spec = np.fft.rfft(de_mean(interpData),nfft,norm='ortho')
-    fs = np.fft.rfftfreq(nfft,interpTimes[1])
+def plot_Milankovitch(filename,nfft=None,figsize=(10,8)):
+    import matplotlib.pyplot as plt
+    sa = SpectralAnalysis(load_data(filename),nfft=nfft)
 
     plt.figure(figsize=figsize)
-    plt.plot(fs,np.real(spec.conj()*spec),'firebrick')
+    plt.plot(sa.fs,sa.power(),'firebrick')
     plt.xlim(0,0.1)
     ymin,ymax = plt.ylim()
     xshift = 0.0025
@@ -45,6 +97,64 @@ def plot_Milankovitch(filename,nfft=40960,figsize=(10,8)):
     plt.ylim(0,ymax)
     plt.show()
 
+def interpolate_stream(data,ninterp=4096,chunk=65536):
+    # The same uniform resampling as interpolate_data, generated chunk samples
+    # at a time as (times, values), so the full series never has to be held in memory
+    ages = np.asarray(data.Age_kaBP)
+    rsl = np.asarray(data.RSL_m)
+    dt = ages[-1]/(ninterp-1)
+    for start in range(0,ninterp,chunk):
+        t = np.arange(start,min(start+chunk,ninterp))*dt
+        yield t,np.interp(t,ages,rsl)
+
+def spectrogram(data,window=200.,overlap=0.75,ninterp=4096,pad=4,chunk=65536):
+    # Short-time power spectrum of the resampled record: windows of `window` kyr,
+    # overlapping by the fraction `overlap`, each de-meaned and Hann-tapered.
+    # Returns the frequencies and a generator of (centre times, power) blocks,
+    # power having one row per window. The record is streamed through
+    # interpolate_stream; each chunk's windows are strided views of one buffer
+    # and are transformed together in a single FFT call.
+    from numpy.lib.stride_tricks import sliding_window_view
+    dt = np.asarray(data.Age_kaBP)[-1]/(ninterp-1)
+    nperseg = int(round(window/dt))
+    if not 1 < nperseg <= ninterp:
+        raise ValueError('Window must span between 2 and ninterp samples')
+    step = max(1,int(round(nperseg*(1-overlap))))
+    nfft = next_fast_length(pad*nperseg)
+    taper = np.hanning(nperseg)
+    freqs = np.fft.rfftfreq(nfft,dt)
+    def blocks():
+        buf = np.zeros(0)
+        pos = 0   # sample number of buf[0]
+        for t,v in interpolate_stream(data,ninterp,chunk):
+            buf = np.concatenate((buf,v))
+            if buf.shape[0] < nperseg:
+                continue
+            segs = sliding_window_view(buf,nperseg)[::step]
+            nw = segs.shape[0]
+            spec = np.fft.rfft((segs-segs.mean(axis=1,keepdims=True))*taper,nfft,axis=1,norm='ortho')
+            yield (pos+np.arange(nw)*step+(nperseg-1)/2.)*dt,np.real(spec.conj()*spec)
+            buf = buf[nw*step:]
+            pos += nw*step
+    return freqs,blocks()
+
+def plot_spectrogram(filename,window=200.,overlap=0.9,ninterp=4096,figsize=(10,8)):
+    import matplotlib.pyplot as plt
+    freqs,blocks = spectrogram(load_data(filename),window,overlap,ninterp)
+    times,power = zip(*blocks)
+    times = np.concatenate(times)
+    power = np.vstack(power)
+    plt.figure(figsize=figsize)
+    plt.pcolormesh(times,freqs,power.T,shading='nearest',cmap='magma')
+    for period in [23,41,100]:
+        plt.axhline(1/period,color='w',ls='--',lw=0.5)
+    plt.ylim(0,0.1)
+    plt.yticks([1/x for x in [10,20,30,40,50,100]],[10,20,30,40,50,100])
+    plt.xlabel("Age (kaBP)")
+    plt.ylabel("Period/kyr")
+    plt.gca().invert_xaxis()
+    plt.show()
+
 def cosineLowPass(f,flo,fhi):
     return np.where(f<flo,1,np.where(f>fhi,0,0.5*(1+np.cos(np.pi*((f-flo)/(fhi-flo))))))
 
@@ -58,14 +168,66 @@ def gaussianBandPass(f,fcen,w):
     return np.exp(-(f-fcen)**2 / (2*w**2))
 
 
-def plot_filtered(filename,filt,nfft=40960,figsize=(10,8)):
-    data = pd.read_excel(filename)
-    interpTimes, interpData = interpolate_data(data)
+def next_fast_length(n):
+    # Smallest 2^a 3^b 5^c >= n; FFTs of these lengths are the fastest
+    best = 2**int(np.ceil(np.log2(n)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            m = p35
+            while m < n:
+                m *= 2
+            best = min(best,m)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+class SpectralAnalysis:
+    # Interpolates a record and Fourier transforms it once, so that any number
+    # of filters can then be tried against the same spectrum.
+    #
+    #   sa = SpectralAnalysis(load_data("RSL_data.xlsx"))
+    #   filtered = sa.apply([lambda f: gaussianBandPass(f,1/41,0.002),
+    #                        lambda f: gaussianBandPass(f,1/23,0.002)])
+    #
+    # The padded length is the next fast FFT length at or above pad times the
+    # record length (pad=10 reproduces the old nfft=40960 for 4096 points).
+    def __init__(self,data,ninterp=4096,nfft=None,pad=10):
+        self.times,self.values = interpolate_data(data,ninterp)
+        if nfft is None:
+            nfft = next_fast_length(pad*self.values.shape[0])
+        self.nfft = nfft
+        self.spec = np.fft.rfft(de_mean(self.values),nfft,norm='ortho')
+        self.fs = np.fft.rfftfreq(nfft,self.times[1])
+
+    def power(self):
+        return np.real(self.spec.conj()*self.spec)
+
+    def gains(self,filters):
+        # (nfilters, nfreq) array of filter responses. filters may be a list of
+        # functions of frequency, or an array of responses already evaluated on fs.
+        if callable(filters):
+            filters = [filters]
+        if isinstance(filters,np.ndarray):
+            return np.atleast_2d(filters)
+        return np.array([filt(self.fs) for filt in filters])
+
+    def filtered_spectra(self,filters):
+        return self.gains(filters)*self.spec
 
-    spec = np.fft.rfft(de_mean(interpData),nfft,norm='ortho')
-    fs = np.fft.rfftfreq(nfft,interpTimes[1])
+    def apply(self,filters):
+        # All filtered series at once, one per row: a single broadcast multiply
+        # and a single batched inverse FFT
+        fspec = self.filtered_spectra(filters)
+        return np.fft.irfft(fspec,self.nfft,axis=-1,norm='ortho')[:,:self.values.shape[0]]
 
-    fspec = filt(fs)*spec
+def plot_filtered(filename,filt,nfft=None,figsize=(10,8)):
+    import matplotlib.pyplot as plt
+    sa = SpectralAnalysis(load_data(filename),nfft=nfft)
+    interpTimes = sa.times
+    fs = sa.fs
+    fspec = sa.filtered_spectra(filt)[0]
     plt.figure(figsize=figsize)
     plt.subplot(211)
     plt.plot(fs,np.real(np.conj(fspec)*fspec))
@@ -74,7 +236,7 @@ def plot_filtered(filename,filt,nfft=40960,figsize=(10,8)):
     plt.xlabel("Period/kyr")
     plt.ylabel("Power")
     plt.subplot(212)
-    plt.plot(interpTimes,np.fft.irfft(fspec,nfft, norm='ortho')[0:interpData.shape[0]])
+    plt.plot(interpTimes,sa.apply(filt)[0])
     plt.xlabel("Age (kaBP)")
     plt.ylabel("RSL (m); filtered")
     plt.gca().invert_xaxis()
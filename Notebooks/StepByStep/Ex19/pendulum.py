@@ -1,8 +1,15 @@
+import time
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.animation as anim
 import scipy.integrate as integ
 
+# Callables appended to CALLBACKS are handed a record of the odeint work
+# (RHS evaluations, steps, wall time) after every integration; see instrumentation.py
+CALLBACKS = []
+
+def _report(function,start,**counts):
+    record = dict(function=function,calls=1,time=time.perf_counter()-start,**counts)
+    for callback in CALLBACKS:
+        callback(record)
 
 def simplePendulum(y,t,length,alpha):
     GRAV = 9.81
@@ -12,27 +19,71 @@ def simplePendulumIntegration(initialAngle = np.pi/4,length=0.1,alpha=0.2,timest
     if timesteps is None:
         timesteps = np.linspace(0,10,500)
     y0 = np.array([initialAngle,0.])
-    y = integ.odeint(simplePendulum,y0,timesteps,args=(length,alpha))
+    start = time.perf_counter()
+    y,info = integ.odeint(simplePendulum,y0,timesteps,args=(length,alpha),full_output=True)
+    if CALLBACKS:
+        _report('simplePendulumIntegration',start,evaluations=int(info['nfe'][-1]),iterations=int(info['nst'][-1]))
     return y
 
-def simplePendulumAnimation(initialAngle = np.pi/4,length=0.1,alpha=0.,timesteps=None):
+def simplePendulumEnsemble(initialAngles,lengths=0.1,alphas=0.2,timesteps=None):
+    # Integrate a whole batch of simple pendulums in a single odeint call.
+    # initialAngles, lengths and alphas are broadcast against each other;
+    # the result has shape (n_runs, n_times, 2).
+    if timesteps is None:
+        timesteps = np.linspace(0,10,500)
+    initialAngles,lengths,alphas = np.broadcast_arrays(np.atleast_1d(initialAngles).astype(float),lengths,alphas)
+    initialAngles,lengths,alphas = initialAngles.ravel(),lengths.ravel(),alphas.ravel()
+    nRuns = initialAngles.shape[0]
+    # State is interleaved (angle0,omega0,angle1,omega1,...) so that the Jacobian
+    # is banded: odeint then never builds a dense (2n x 2n) matrix.
+    y0 = np.zeros((nRuns,2))
+    y0[:,0] = initialAngles
+    def ensemble(y,t,length,alpha):
+        return simplePendulum(y.reshape(nRuns,2).T,t,length,alpha).T.ravel()
+    y = integ.odeint(ensemble,y0.ravel(),timesteps,args=(lengths,alphas),ml=1,mu=1)
+    return y.reshape(len(timesteps),nRuns,2).transpose(1,0,2)
+
+def _saveAnimation(a,fig,plotter,nframes,filename,fps):
+    # Stream frames to disk one at a time rather than holding them all in memory.
+    # A filename containing a %-format (e.g. 'frame%04d.png') gives an image
+    # sequence; anything else goes to the matplotlib writer for that extension
+    # (ffmpeg for .mp4, pillow for .gif, ...).
+    import matplotlib.pyplot as plt
+    if '%' in filename:
+        for i in range(nframes):
+            plotter(i)
+            fig.savefig(filename%i)
+    else:
+        a.save(filename,fps=fps)
+    plt.close(fig)
+
+def simplePendulumAnimation(initialAngle = np.pi/4,length=0.1,alpha=0.,timesteps=None,filename=None,fps=33):
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as anim
     y = simplePendulumIntegration(initialAngle,length,alpha,timesteps)
+    # Bob positions for every frame, computed once
+    bx = -length*np.sin(y[:,0])
+    by = -length*np.cos(y[:,0])
     fig = plt.figure()
     plt.gca().set_aspect('equal')
     plt.xlim(-1.5*length,1.5*length)
     plt.ylim(-1.5*length,1.5*length)
     plt.xticks([])
     plt.yticks([])
-    pendulumString, = plt.plot([0,-length*np.sin(y[0,0])],[0,-length*np.cos(y[0,0])],'k')
-    pendulumBob, = plt.plot(-length*np.sin(y[0,0]),-length*np.cos(y[0,0]),'ok')
+    pendulumString, = plt.plot([0,bx[0]],[0,by[0]],'k')
+    pendulumBob, = plt.plot(bx[:1],by[:1],'ok')
     def plotter(i):
-        pendulumString.set_data(([0,-length*np.sin(y[i,0])],[0,-length*np.cos(y[i,0])]))
-        pendulumBob.set_data((-length*np.sin(y[i,0]),-length*np.cos(y[i,0])))
-    a = anim.FuncAnimation(fig,plotter,frames=len(y),interval=30)
+        pendulumString.set_data(([0,bx[i]],[0,by[i]]))
+        pendulumBob.set_data((bx[i:i+1],by[i:i+1]))
+        return pendulumString,pendulumBob
+    a = anim.FuncAnimation(fig,plotter,frames=len(y),interval=30,blit=True)
+    if filename is not None:
+        _saveAnimation(a,fig,plotter,len(y),filename,fps)
     return a
     ## Display with:
     # from IPython.display import HTML
     # HTML(a.to_jshtml())
+    ## or write straight to disk with filename='pendulum.mp4' (or 'frame%04d.png')
     
 def doublePendulum(y,t,mass,length):
     GRAV = 9.81
@@ -47,36 +98,144 @@ def doublePendulumIntegration(initialAngles = (7*np.pi/8,-11*np.pi/12),length=0.
     if timesteps is None:
         timesteps = np.linspace(0,10,500)
     y0 = np.array([initialAngles[0],initialAngles[1],0.,0.])
-    y = integ.odeint(doublePendulum,y0,timesteps,args=(mass,length))
+    start = time.perf_counter()
+    y,info = integ.odeint(doublePendulum,y0,timesteps,args=(mass,length),full_output=True)
+    if CALLBACKS:
+        _report('doublePendulumIntegration',start,evaluations=int(info['nfe'][-1]),iterations=int(info['nst'][-1]))
     return y
+
+def doublePendulumTimeToFlip(initialAngles,length=0.1,mass=1,tmax=10.,dt=0.02,nblock=50):
+    # Time until either rod first passes through the vertical (|theta|>pi).
+    # Returns np.inf if no flip happens before tmax.
+    th1,th2 = initialAngles
+    if 3*np.cos(th1)+np.cos(th2) > 2:
+        # Not enough energy to ever flip: no need to integrate at all
+        return np.inf
+    y = np.array([th1,th2,0.,0.])
+    t = 0.
+    while t < tmax:
+        timesteps = t+dt*np.arange(nblock+1)
+        yb = integ.odeint(doublePendulum,y,timesteps,args=(mass,length))
+        flipped = np.nonzero(np.any(np.abs(yb[:,:2])>np.pi,axis=1))[0]
+        if flipped.size>0:
+            return timesteps[flipped[0]]
+        y = yb[-1]
+        t = timesteps[-1]
+    return np.inf
+
+def doublePendulumLyapunov(initialAngles,length=0.1,mass=1,tmax=10.,dt=0.5,d0=1e-8,tol=1e-3,tmin=2.):
+    # Estimate of the largest Lyapunov exponent (Benettin's method): a reference
+    # and a perturbed trajectory are advanced together, the separation is renormalised
+    # to d0 every dt and the log-growth averaged. Stops once the running estimate
+    # changes by less than tol between renormalisations (after tmin).
+    y = np.array([initialAngles[0],initialAngles[1],0.,0.])
+    yp = y + d0/2.
+    def pair(z,t,mass,length):
+        return np.concatenate((doublePendulum(z[:4],t,mass,length),doublePendulum(z[4:],t,mass,length)))
+    z = np.concatenate((y,yp))
+    t = 0.
+    logGrowth = 0.
+    estimate = 0.
+    while t < tmax:
+        z = integ.odeint(pair,z,[0,dt],args=(mass,length))[-1]
+        t += dt
+        d = np.linalg.norm(z[4:]-z[:4])
+        logGrowth += np.log(d/d0)
+        z[4:] = z[:4] + (z[4:]-z[:4])*(d0/d)
+        previous,estimate = estimate,logGrowth/t
+        if t >= tmin and abs(estimate-previous) < tol:
+            break
+    return estimate
+
+def _doublePendulumSweepRow(args):
+    i,th1,th2s,metric,kwargs = args
+    if metric == 'flip':
+        f = doublePendulumTimeToFlip
+    else:
+        f = doublePendulumLyapunov
+    return i,np.array([f((th1,th2),**kwargs) for th2 in th2s])
+
+def doublePendulumGridSweep(filename,th1s=None,th2s=None,metric='flip',nprocs=None,**kwargs):
+    # Evaluate a metric ('flip' or 'lyapunov') over a grid of initial angles.
+    # Rows of the grid are farmed out to a process pool and written into a .npy
+    # memory map as they complete; cells still holding NaN are unfinished, so
+    # calling again with the same filename resumes an interrupted sweep.
+    # Extra keyword arguments are passed on to the metric function.
+    # The angles, metric and keyword arguments are saved in <filename>.json,
+    # and resuming with different ones raises ValueError rather than mixing
+    # two sweeps in one map.
+    # The default grid is 512 cell centres across (-pi, pi), so no row or
+    # column starts at |theta| = pi, which would count as flipped at once.
+    import os
+    import json
+    import multiprocessing
+    if th1s is None:
+        th1s = (np.arange(512)+0.5)*2*np.pi/512-np.pi
+    if th2s is None:
+        th2s = (np.arange(512)+0.5)*2*np.pi/512-np.pi
+    if metric not in ('flip','lyapunov'):
+        raise ValueError('Unrecognised metric')
+    shape = (len(th1s),len(th2s))
+    # Round trip through JSON so that a fresh description compares equal to a saved one
+    params = json.loads(json.dumps({'metric':metric,'th1s':[float(t) for t in th1s],
+                                    'th2s':[float(t) for t in th2s],'kwargs':kwargs}))
+    paramsFile = filename+'.json'
+    if os.path.exists(filename):
+        if not os.path.exists(paramsFile):
+            raise ValueError('No %s describing the existing sweep in %s'%(paramsFile,filename))
+        with open(paramsFile) as f:
+            saved = json.load(f)
+        for key in ('metric','th1s','th2s','kwargs'):
+            if saved.get(key) != params[key]:
+                raise ValueError('Existing sweep in %s was run with different %s'%(filename,key))
+        out = np.lib.format.open_memmap(filename,mode='r+')
+        if out.shape != shape:
+            raise ValueError('Existing sweep in %s has shape %s, not %s'%(filename,out.shape,shape))
+    else:
+        with open(paramsFile,'w') as f:
+            json.dump(params,f)
+        out = np.lib.format.open_memmap(filename,mode='w+',dtype=np.float64,shape=shape)
+        out[:] = np.nan
+        out.flush()
+    todo = [(i,th1s[i],th2s,metric,kwargs) for i in range(shape[0]) if np.isnan(out[i]).any()]
+    with multiprocessing.Pool(nprocs) as pool:
+        for i,row in pool.imap_unordered(_doublePendulumSweepRow,todo):
+            out[i] = row
+            out.flush()
+    return out
                     
     
     
-def doublePendulumAnimation(initialAngles = (7*np.pi/8,-11*np.pi/12),length=0.1,mass=1,timesteps=None):
+def doublePendulumAnimation(initialAngles = (7*np.pi/8,-11*np.pi/12),length=0.1,mass=1,timesteps=None,trail=100,filename=None,fps=33):
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as anim
     y = doublePendulumIntegration(initialAngles,length,mass,timesteps)
+    # Joint and bob positions for every frame, computed once
+    x1 = -length*np.sin(y[:,0])
+    y1 = -length*np.cos(y[:,0])
+    x2 = x1-length*np.sin(y[:,1])
+    y2 = y1-length*np.cos(y[:,1])
     fig = plt.figure()
     plt.gca().set_aspect('equal')
     plt.xlim(-2.5*length,2.5*length)
     plt.ylim(-2.5*length,2.5*length)
     p, = plt.plot([],[],'r-')
-    st1, = plt.plot([0,-length*np.sin(y[0,0])],[0,-length*np.cos(y[0,0])],'k')
-    st2, = plt.plot([-length*np.sin(y[0,0]),-length*np.sin(y[0,0])-length*np.sin(y[0,1])],
-                    [-length*np.cos(y[0,0]),-length*np.cos(y[0,0])-length*np.cos(y[0,1])])
+    st1, = plt.plot([0,x1[0]],[0,y1[0]],'k')
+    st2, = plt.plot([x1[0],x2[0]],[y1[0],y2[0]])
     def plotter(i):
-        px,py = p.get_data()
-        #print(px,py,type(px),type(py))
-        if not type(px)is type([]):
-            px = px.tolist()
-        if not type(py) is type([]):
-            py = py.tolist()
-        i0 = 0#max(0,len(px)-100)
-        p.set_data((px[i0:]+[-length*np.sin(y[i,0])-length*np.sin(y[i,1])],
-                    py[i0:]+[-length*np.cos(y[i,0])-length*np.cos(y[i,1])]))
-        st1.set_data(([0,-length*np.sin(y[i,0])],[0,-length*np.cos(y[i,0])]))
-        st2.set_data(([-length*np.sin(y[i,0]),-length*np.sin(y[i,0])-length*np.sin(y[i,1])],
-                      [-length*np.cos(y[i,0]),-length*np.cos(y[i,0])-length*np.cos(y[i,1])]))
-    a = anim.FuncAnimation(fig,plotter,frames=len(y),interval=30)
+        # The trail is a fixed-length window onto the precomputed path, so
+        # every frame costs the same however far into the animation we are.
+        # trail=None keeps the whole path.
+        i0 = 0 if trail is None else max(0,i+1-trail)
+        p.set_data((x2[i0:i+1],y2[i0:i+1]))
+        st1.set_data(([0,x1[i]],[0,y1[i]]))
+        st2.set_data(([x1[i],x2[i]],[y1[i],y2[i]]))
+        return p,st1,st2
+    a = anim.FuncAnimation(fig,plotter,frames=len(y),interval=30,blit=True)
+    if filename is not None:
+        _saveAnimation(a,fig,plotter,len(y),filename,fps)
     return a
     ## Display with:
     # from IPython.display import HTML
-    # HTML(a.to_jshtml())
\ No newline at end of file
+    # HTML(a.to_jshtml())
+    ## or write straight to disk with filename='pendulum.mp4' (or 'frame%04d.png')
@@ -1,57 +1,127 @@
-import matplotlib.pyplot as plt
-import matplotlib.animation as anim
 import numpy as np
-from IPython.display import HTML
-anim.rcParams['animation.embed_limit']=40
+import time
+
+class SortTrace:
+    # Record of a sort as the initial array plus the sequence of swaps performed,
+    # held in a (nswaps, 2) integer array. Frame k (the array after k swaps) is
+    # rebuilt on demand, so memory grows with the number of swaps, not swaps*n.
+    # Indexing behaves like the old list of states: trace[k], trace[-1], len(trace).
+    # Comparisons made through less() and swaps are counted; with record=False
+    # only the counts are kept (no frames), which is what the benchmarks use.
+    def __init__(self,a,record=True):
+        self.initial = a.copy() if record else None
+        self._swaps = np.empty((64,2),dtype=np.intp) if record else None
+        self.nswaps = 0
+        self.ncompare = 0
+        self._frame = a.copy() if record else None
+        self._k = 0
+
+    def less(self,a,i,j):
+        # a[i] < a[j], counted
+        self.ncompare += 1
+        return a[i] < a[j]
+
+    def swap(self,a,i,j):
+        # Swap a[i] and a[j] and record it
+        x = a[j]
+        a[j] = a[i]
+        a[i] = x
+        if self._swaps is not None:
+            if self.nswaps == self._swaps.shape[0]:
+                self._swaps = np.concatenate((self._swaps,np.empty_like(self._swaps)))
+            self._swaps[self.nswaps] = i,j
+        self.nswaps += 1
+
+    @property
+    def recorded(self):
+        return self._swaps is not None
+
+    @property
+    def swaps(self):
+        if not self.recorded:
+            return None
+        return self._swaps[:self.nswaps]
+
+    def __len__(self):
+        return self.nswaps+1
+
+    def _advance(self,k):
+        # Move the cached frame to frame k; going forwards only replays the new swaps
+        if not self.recorded:
+            raise ValueError('Swaps were not recorded for this sort')
+        if k < self._k:
+            self._frame[:] = self.initial
+            self._k = 0
+        f = self._frame
+        for i,j in self._swaps[self._k:k].tolist():
+            x = f[j]
+            f[j] = f[i]
+            f[i] = x
+        self._k = k
+
+    def __getitem__(self,k):
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError('frame index out of range')
+        self._advance(k)
+        return self._frame.copy()
+
+    def frames(self,stride=1):
+        # Iterate over every stride-th frame (always including the final one)
+        last = len(self)-1
+        for k in list(range(0,last,stride))+[last]:
+            self._advance(k)
+            yield self._frame.copy()
 
 def isSorted(a):
     for i in range(len(a)-1):
         if a[i+1]<a[i]: return False
     return True
-def gnomeSort(a):
-    states=[a.copy()]
+def gnomeSort(a,record=True):
+    # The gnome walks forward until it finds an inversion, then carries the
+    # smaller value back to where it belongs. This always swaps the first
+    # inversion in the array, without rescanning it from the start each time.
+    states=SortTrace(a,record)
     pairs = []
-    while not isSorted(a):
-        for i in range(0,len(a)-1):
-            if a[i+1]<a[i]:
-                pairs+=[(a[i],a[i+1])]
-                x = a[i+1]
-                a[i+1] = a[i]
-                a[i] = x
-                break
-        states+=[a.copy()]
+    i = 0
+    while i < len(a)-1:
+        if states.less(a,i+1,i):
+            if record: pairs+=[(a[i],a[i+1])]
+            states.swap(a,i,i+1)
+            i = max(i-1,0)
+        else:
+            i+=1
     return states,pairs
-def bubbleSort(a):
-    states=[a.copy()]
+def bubbleSort(a,record=True):
+    states=SortTrace(a,record)
     pairs = []
-    while not isSorted(a):
-        for i in range(0,len(a)-1):
-            if a[i+1]<a[i]:
-                pairs+=[(a[i],a[i+1])]
-                x = a[i+1]
-                a[i+1] = a[i]
-                a[i] = x
-                states+=[a.copy()]
+    n = len(a)
+    swapped = True
+    while swapped:
+        swapped = False
+        for i in range(0,n-1):
+            if states.less(a,i+1,i):
+                if record: pairs+=[(a[i],a[i+1])]
+                states.swap(a,i,i+1)
+                swapped = True
+        # The largest remaining value has bubbled to the end
+        n -= 1
     return states,pairs
-def selectionSort(a):
-    firstUnsorted = 0
-    states=[a.copy()]
+def selectionSort(a,record=True):
+    states=SortTrace(a,record)
     pairs = []
-    while not isSorted(a):
+    for firstUnsorted in range(0,len(a)-1):
         i = firstUnsorted+np.argmin(a[firstUnsorted:])
+        states.ncompare += len(a)-firstUnsorted-1
         if i==firstUnsorted:
-            firstUnsorted+=1
             continue
-        pairs+=[(firstUnsorted,i)]
-        x = a[firstUnsorted]
-        a[firstUnsorted] = a[i]
-        a[i] = x
-        firstUnsorted+=1
-        states+=[a.copy()]
+        if record: pairs+=[(firstUnsorted,i)]
+        states.swap(a,firstUnsorted,i)
         
     return states,pairs
-def shellSort(a,seq=[10,4,1]):
-    states=[a.copy()]
+def shellSort(a,seq=[10,4,1],record=True):
+    states=SortTrace(a,record)
     pairs = []
     for s in seq:
         for i0 in range(0,s):
@@ -67,85 +137,274 @@ def shellSort(a,seq=[10,4,1]):
                         j=0
                         done=True
                         continue
-                if a[k2]<a[k1]:
+                if states.less(a,k2,k1):
                     done = False
-                    pairs+=[(k1,k2)]
-                    x = a[k2]
-                    a[k2] = a[k1]
-                    a[k1] = x
+                    if record: pairs+=[(k1,k2)]
+                    states.swap(a,k1,k2)
                     #j = max(j-2,-1)
-                    states+=[a.copy()]
-                    if isSorted(a): return states,pairs
                 j+=1
     return states,pairs
+def shellGaps(n):
+    # Knuth's gap sequence 1, 4, 13, 40, ... (largest first) for an array of length n
+    gaps = [1]
+    while 3*gaps[-1]+1 < n//3:
+        gaps += [3*gaps[-1]+1]
+    return gaps[::-1]
+
+# The fast sorts below return (trace, index pairs swapped), like selectionSort and shellSort
+
+def _merge(a,states,lo,mid,hi):
+    # Merge sorted runs a[lo:mid] and a[mid:hi]. The merged order is worked out
+    # first, then applied with at most hi-lo-1 swaps by following where each
+    # element currently sits.
+    order = []
+    i,j = lo,mid
+    while i < mid and j < hi:
+        if states.less(a,j,i):
+            order.append(j)
+            j+=1
+        else:
+            order.append(i)
+            i+=1
+    order += list(range(i,mid))+list(range(j,hi))
+    where = list(range(lo,hi))  # current position of each original element
+    held = list(range(lo,hi))   # original element currently at each position
+    for k,src in enumerate(order):
+        d = lo+k
+        s = where[src-lo]
+        if s != d:
+            states.swap(a,d,s)
+            e = held[k]
+            held[k],held[s-lo] = src,e
+            where[src-lo],where[e-lo] = d,s
+def mergeSort(a,record=True):
+    # Bottom-up (iterative) merge sort
+    states=SortTrace(a,record)
+    n = len(a)
+    width = 1
+    while width < n:
+        for lo in range(0,n,2*width):
+            mid = min(lo+width,n)
+            hi = min(lo+2*width,n)
+            if mid < hi:
+                _merge(a,states,lo,mid,hi)
+        width *= 2
+    return states,states.swaps
+def _partition(a,states,lo,hi):
+    # Partition a[lo:hi] around a median-of-three pivot; returns the pivot's final index.
+    # Scans stop on keys equal to the pivot, so runs of equal values still split evenly.
+    mid = (lo+hi-1)//2
+    if states.less(a,mid,lo): states.swap(a,lo,mid)
+    if states.less(a,hi-1,lo): states.swap(a,lo,hi-1)
+    if states.less(a,mid,hi-1): states.swap(a,mid,hi-1)
+    p = hi-1
+    i,j = lo-1,hi-1
+    while True:
+        i+=1
+        while states.less(a,i,p): i+=1
+        j-=1
+        while j > lo and states.less(a,p,j): j-=1
+        if i >= j:
+            break
+        states.swap(a,i,j)
+    if i != p:
+        states.swap(a,i,p)
+    return i
+def quickSort(a,record=True):
+    # Iterative quicksort; the smaller side is always handled first so the stack stays O(log n)
+    states=SortTrace(a,record)
+    stack = [(0,len(a))]
+    while stack:
+        lo,hi = stack.pop()
+        if hi-lo < 2:
+            continue
+        p = _partition(a,states,lo,hi)
+        parts = sorted([(lo,p),(p+1,hi)],key=lambda r: r[0]-r[1])
+        stack += parts
+    return states,states.swaps
+def _siftDown(a,states,lo,root,n):
+    # Restore the max-heap a[lo:lo+n] below root
+    while True:
+        child = 2*root+1
+        if child >= n:
+            break
+        if child+1 < n and states.less(a,lo+child,lo+child+1):
+            child += 1
+        if not states.less(a,lo+root,lo+child):
+            break
+        states.swap(a,lo+root,lo+child)
+        root = child
+def _heapSortRange(a,states,lo,hi):
+    n = hi-lo
+    for root in range(n//2-1,-1,-1):
+        _siftDown(a,states,lo,root,n)
+    for end in range(n-1,0,-1):
+        states.swap(a,lo,lo+end)
+        _siftDown(a,states,lo,0,end)
+def heapSort(a,record=True):
+    states=SortTrace(a,record)
+    _heapSortRange(a,states,0,len(a))
+    return states,states.swaps
+def _insertionSortRange(a,states,lo,hi):
+    for i in range(lo+1,hi):
+        j = i
+        while j > lo and states.less(a,j,j-1):
+            states.swap(a,j-1,j)
+            j -= 1
+def introSort(a,record=True,small=16):
+    # Quicksort that falls back to heapsort when partitioning goes too deep
+    # (so never worse than O(n log n)), with insertion sort for short ranges.
+    states=SortTrace(a,record)
+    maxDepth = 2*int(np.log2(max(len(a),1)))
+    stack = [(0,len(a),maxDepth)]
+    while stack:
+        lo,hi,depth = stack.pop()
+        if hi-lo <= small:
+            _insertionSortRange(a,states,lo,hi)
+        elif depth == 0:
+            _heapSortRange(a,states,lo,hi)
+        else:
+            p = _partition(a,states,lo,hi)
+            parts = sorted([(lo,p),(p+1,hi)],key=lambda r: r[0]-r[1])
+            stack += [(l,h,depth-1) for l,h in parts]
+    return states,states.swaps
+
+SORTS = {'gnome':gnomeSort,
+         'bubble':bubbleSort,
+         'selection':selectionSort,
+         'shell':lambda a,record=True: shellSort(a,shellGaps(len(a)),record),
+         'merge':mergeSort,
+         'quick':quickSort,
+         'heap':heapSort,
+         'intro':introSort}
+
+def makeInput(kind,n,rng=None):
+    # Test arrays: 'random', 'sorted', 'reversed' or 'nearly' (sorted, then 1% of
+    # positions swapped with a random neighbour up to 10 places away)
+    if rng is None:
+        rng = np.random.default_rng()
+    if kind == 'random':
+        return rng.permutation(n)
+    elif kind == 'sorted':
+        return np.arange(n)
+    elif kind == 'reversed':
+        return np.arange(n)[::-1].copy()
+    elif kind == 'nearly':
+        a = np.arange(n)
+        if n < 2:
+            return a
+        i = rng.integers(0,n,max(n//100,1))
+        j = np.clip(i+rng.integers(1,11,i.shape[0]),0,n-1)
+        for k,l in zip(i,j):
+            a[k],a[l] = a[l],a[k]
+        return a
+    else:
+        raise ValueError('Unrecognised input kind')
+
+# Worst-case growth of each algorithm's running time. benchmark() predicts the
+# time for the next size from it until it has timings to measure the growth from.
+COMPLEXITY = {'gnome':'n^2','bubble':'n^2','selection':'n^2','shell':'n^2',
+              'merge':'n log n','quick':'n log n','heap':'n log n','intro':'n log n'}
+_GROWTH = {'n^2':lambda n: float(n)**2,'n log n':lambda n: n*np.log(max(n,2))}
+
+def benchmark(sizes=(10,100,1000,10000,100000,1000000),kinds=('random','sorted','reversed','nearly'),
+              algorithms=None,budget=5.,seed=0):
+    # Time every algorithm on every kind of input at each size, counting comparisons
+    # and swaps. Only the quadratic algorithms (and any not in COMPLEXITY) are
+    # cut short: once the predicted time for their next size exceeds budget
+    # seconds, the larger sizes are skipped for that algorithm and input kind.
+    # The n log n sorts run every size. Returns a list of dicts, one per run.
+    if algorithms is None:
+        algorithms = list(SORTS)
+    rng = np.random.default_rng(seed)
+    results = []
+    for kind in kinds:
+        for name in algorithms:
+            complexity = COMPLEXITY.get(name,'n^2')
+            growth = _GROWTH[complexity]
+            previous = None
+            for n in sorted(sizes):
+                if complexity == 'n^2' and previous is not None:
+                    n0,t0,exponent = previous
+                    # Measured power law if there is one, otherwise the known complexity
+                    if exponent is None:
+                        predicted = t0*growth(n)/growth(n0)
+                    else:
+                        predicted = t0*(n/n0)**exponent
+                    if predicted > budget:
+                        break
+                a = makeInput(kind,n,rng)
+                t = time.perf_counter()
+                states,_ = SORTS[name](a,record=False)
+                elapsed = time.perf_counter()-t
+                if not isSorted(a):
+                    raise RuntimeError('%s sort failed on %s input of size %i'%(name,kind,n))
+                results.append({'algorithm':name,'kind':kind,'n':n,'time':elapsed,
+                                'comparisons':states.ncompare,'swaps':states.nswaps})
+                # Only trust the measured growth once both timings are long enough
+                exponent = None
+                if previous is not None and previous[1] > 1e-3:
+                    exponent = max(np.log(elapsed/previous[1])/np.log(n/previous[0]),1.)
+                previous = (n,elapsed,exponent)
+    return results
+
+def plotBenchmark(results,quantity='time',figsize=(12,8)):
+    # Log-log scaling curves of time, comparisons or swaps against n, one panel per input kind
+    import matplotlib.pyplot as plt
+    kinds = list(dict.fromkeys(r['kind'] for r in results))
+    plt.figure(figsize=figsize)
+    for k,kind in enumerate(kinds):
+        plt.subplot(2,(len(kinds)+1)//2,k+1)
+        for name in dict.fromkeys(r['algorithm'] for r in results):
+            rs = [r for r in results if r['kind']==kind and r['algorithm']==name]
+            plt.loglog([r['n'] for r in rs],[max(r[quantity],1e-9) for r in rs],'o-',label=name)
+        plt.title(kind)
+        plt.xlabel('n')
+        plt.ylabel(quantity)
+    plt.legend()
+    plt.tight_layout()
+    plt.show()
+
+def demo(filename='tmp.html',n=100,seed=None):
+    # Animate gnome, bubble, selection and shell sort side by side on the same
+    # shuffled data, write the animation to filename as HTML (none if None)
+    # and return the HTML. Each panel turns green once its sort has finished.
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as anim
+    plt.rcParams['animation.embed_limit'] = 40
+    data = np.random.default_rng(seed).permutation(n)
+    runs = [("Gnome sort",gnomeSort(data.copy())[0]),
+            ("Bubble sort",bubbleSort(data.copy())[0]),
+            ("Selection sort",selectionSort(data.copy())[0]),
+            ("Shell sort",shellSort(data.copy(),seq=[50,25,12,6,3,1])[0])]
+    fig = plt.figure(figsize=(8,3))
+    panels = []
+    for k,(title,states) in enumerate(runs):
+        ax = plt.subplot(len(runs),1,k+1)
+        im = plt.imshow(data.reshape(1,n),aspect=5,cmap=plt.cm.jet)
+        plt.title(title)
+        plt.xticks([])
+        plt.yticks([])
+        plt.ylim(-0.7,0.7)
+        plt.xlim(-1.5,n+0.5)
+        panels.append((ax,im,states))
+    plt.tight_layout()
+
+    def animator(i):
+        for ax,im,states in panels:
+            try:
+                im.set_data(states[i].reshape(1,n))
+            except IndexError:
+                im.set_data(states[-1].reshape(1,n))
+                ax.set_facecolor('xkcd:mint green')
+
+    ani = anim.FuncAnimation(fig,animator,100+max(len(states) for _,_,states in panels),interval=25)
+    html = ani.to_jshtml()
+    plt.close(fig)
+    if filename is not None:
+        with open(filename,'w') as fp:
+            fp.write(html)
+    return html
 
-data = np.arange(100)
-np.random.shuffle(data)
-np.random.shuffle(data)
-s_gnome,p_gnome = gnomeSort(data.copy())
-s_bubble,p_bubble = bubbleSort(data.copy())
-s_selection,p_selection = selectionSort(data.copy())
-s_shell,p_shell = shellSort(data.copy(),seq=[50,25,12,6,3,1])
-fig=plt.figure(figsize=(8,3))
-ax_gnome = plt.subplot(411)
-im_gnome=plt.imshow(data.reshape(1,data.shape[0]),aspect=5,cmap=plt.cm.jet)
-plt.title("Gnome sort")
-plt.xticks([])
-plt.yticks([])
-plt.ylim(-0.7,0.7)
-plt.xlim(-1.5,data.shape[0]+0.5)
-
-ax_bubble = plt.subplot(412)
-plt.title("Bubble sort")
-im_bubble=plt.imshow(data.reshape(1,data.shape[0]),aspect=5,cmap=plt.cm.jet)
-plt.xticks([])
-plt.yticks([])
-plt.ylim(-0.7,0.7)
-plt.xlim(-1.5,data.shape[0]+0.5)
-ax_selection = plt.subplot(413)
-
-plt.title("Selection sort")
-im_selection=plt.imshow(data.reshape(1,data.shape[0]),aspect=5,cmap=plt.cm.jet)
-plt.xticks([])
-plt.yticks([])
-plt.ylim(-0.7,0.7)
-plt.xlim(-1.5,100.5)
-ax_shell = plt.subplot(414)
-plt.title("Shell sort")
-im_shell=plt.imshow(data.reshape(1,data.shape[0]),aspect=5,cmap=plt.cm.jet)
-plt.xticks([])
-plt.yticks([])
-plt.ylim(-0.7,0.7)
-plt.xlim(-1.5,100.5)
-plt.tight_layout()
-
-
-def animator(i):
-    try:
-        im_gnome.set_data(s_gnome[i].reshape(1,100))
-    except IndexError:
-        im_gnome.set_data(s_gnome[-1].reshape(1,100))
-        ax_gnome.set_facecolor('xkcd:mint green')
-    try:
-        im_bubble.set_data(s_bubble[i].reshape(1,100))
-    except IndexError:
-        im_bubble.set_data(s_bubble[-1].reshape(1,100))
-        ax_bubble.set_facecolor('xkcd:mint green')
-    try:
-        im_selection.set_data(s_selection[i].reshape(1,100))
-    except IndexError:
-        im_selection.set_data(s_selection[-1].reshape(1,100))
-        ax_selection.set_facecolor('xkcd:mint green')
-    try:
-        im_shell.set_data(s_shell[i].reshape(1,100))
-    except IndexError:
-        im_shell.set_data(s_shell[-1].reshape(1,100))
-        ax_shell.set_facecolor('xkcd:mint green')
-    
-ani = anim.FuncAnimation(fig, animator, 100+max([len(s_bubble), len(s_gnome), len(s_shell), 
-                                                 len(s_selection)]), interval=25)
-
-html = ani.to_jshtml()
-fp = open('tmp.html','w')
-fp.write(html)
-fp.close()
\ No newline at end of file
+if __name__ == '__main__':
+    demo()
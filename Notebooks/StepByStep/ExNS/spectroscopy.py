@@ -1,14 +1,58 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import datetime
 import re
+import time
 from scipy.optimize import curve_fit
+
+# Each peak fit passes a record of its curve_fit work to every callable in
+# CALLBACKS (empty unless instrumentation.Recorder is active)
+CALLBACKS = []
+
+def _report(function,start,**counts):
+    record = dict(function=function,calls=1,time=time.perf_counter()-start,**counts)
+    for callback in CALLBACKS:
+        callback(record)
     
 def movingWindow(x,y,n):
-    ny = y.shape[0]
-    out = np.zeros(ny - 2*n)
-    for i in range(n,ny-n):
-        out[i-n] = np.mean(y[i-n:i+n+1])
+    # Running mean over 2n+1 points, via cumulative sums so the cost does not
+    # depend on n. y may be a single spectrum or a 2-D stack (one per row).
+    return smooth(x,y,n,kind='boxcar')
+
+def smooth(x,y,n,kind='boxcar',order=2,sigma=None):
+    # Smooth y (1-D, or 2-D with one spectrum per row) with a window of 2n+1 points.
+    #   kind='boxcar'   running mean (same output as the original movingWindow)
+    #   kind='savgol'   Savitzky-Golay filter of polynomial order `order`
+    #   kind='gaussian' Gaussian kernel of standard deviation sigma points (default n/2)
+    # Like movingWindow, only points with a full window are returned, so the
+    # output is 2n shorter than the input.
+    y = np.asarray(y,dtype=float)
+    ny = y.shape[-1]
+    w = 2*n+1
+    if kind == 'boxcar':
+        # Remove the mean first so the cumulative sum stays small and accurate
+        y0 = y.mean(axis=-1,keepdims=True)
+        c = np.cumsum(y-y0,axis=-1)
+        c = np.concatenate((np.zeros(y.shape[:-1]+(1,)),c),axis=-1)
+        out = (c[...,w:]-c[...,:-w])/w + y0
+    else:
+        from scipy.signal import savgol_coeffs, oaconvolve
+        if kind == 'savgol':
+            kernel = savgol_coeffs(w,order)
+        elif kind == 'gaussian':
+            if sigma is not None and sigma <= 0:
+                raise ValueError('sigma must be positive')
+            if n == 0:
+                # A 1-point window leaves y unchanged, whatever sigma is
+                kernel = np.ones(1)
+            else:
+                if sigma is None:
+                    sigma = n/2.
+                kernel = np.exp(-0.5*(np.arange(-n,n+1)/sigma)**2)
+                kernel /= kernel.sum()
+        else:
+            raise ValueError('Unrecognised smoothing kind')
+        kernel = kernel.reshape((1,)*(y.ndim-1)+(w,))
+        out = oaconvolve(y,kernel,mode='valid',axes=-1)
     return x[n:ny-n],out
 
 def loadSpectralData(filename):
@@ -18,38 +62,119 @@ def loadSpectralData(filename):
     fmin = data[2]
     return fmin,fmax,npts,data[6:]
 
-def plotSpectralData(fmin,fmax,npts,data,filename=None,figsize=(8,6),window=None):
+def parseSpectralFilename(filename):
+    # Split a name like '11octrll32bpanel1s1_2016-10-11T12-48-25.asp' into its
+    # location, panel, sample and timestamp.
+    import os
+    a,b = os.path.basename(filename).rsplit('_',1)
+    info = re.match(r'(\d+[a-z]{3})(?P<location>.*?)panel(?P<panel>\d?)s(?P<sample>\d+)',a)
+    experimentDate = datetime.datetime.strptime(b.replace('.asp',''),'%Y-%m-%dT%H-%M-%S')
+    return info.group('location'),info.group('panel'),info.group('sample'),experimentDate
+
+def _readSpectralHeader(filename):
+    with open(filename) as fp:
+        return int(float(fp.readline()))
+
+def _ingestOne(filename):
+    fmin,fmax,npts,data = loadSpectralData(filename)
+    try:
+        location,panel,sample,experimentDate = parseSpectralFilename(filename)
+    except (AttributeError,ValueError):
+        location,panel,sample,experimentDate = '','',-1,None
+    return filename,location,panel,sample,experimentDate,fmin,fmax,npts,data
+
+def ingestSpectralData(directory,store,pattern='*.asp',nprocs=None,dtype=np.float32):
+    # Parse every spectrum in a directory (in parallel) into a single binary store:
+    #   <store>.npy        (nfiles x npts) array of spectra, NaN-padded if lengths differ
+    #   <store>_index.npy  structured array of filename, location, panel, sample,
+    #                      date, fmin, fmax and npts for each row
+    # Spectra are written to a memory map as they arrive, so the whole campaign
+    # never has to be held in memory. Open the result with loadSpectralStore.
+    import os
+    import glob
+    import multiprocessing
+    filenames = sorted(glob.glob(os.path.join(directory,pattern)))
+    if len(filenames) == 0:
+        raise ValueError('No files matching %s in %s'%(pattern,directory))
+    with multiprocessing.Pool(nprocs) as pool:
+        nmax = max(pool.map(_readSpectralHeader,filenames,chunksize=64))
+        data = np.lib.format.open_memmap(store+'.npy',mode='w+',dtype=dtype,shape=(len(filenames),nmax))
+        index = np.zeros(len(filenames),dtype=[('filename','U%i'%max(len(os.path.basename(f)) for f in filenames)),
+                                               ('location','U32'),('panel','i4'),('sample','i4'),
+                                               ('date','datetime64[s]'),('fmin','f8'),('fmax','f8'),('npts','i4')])
+        for i,rec in enumerate(pool.imap(_ingestOne,filenames,chunksize=64)):
+            filename,location,panel,sample,experimentDate,fmin,fmax,npts,d = rec
+            index[i] = (os.path.basename(filename),location,int(panel) if panel else -1,int(sample),
+                        np.datetime64(experimentDate,'s') if experimentDate else np.datetime64('NaT'),fmin,fmax,npts)
+            data[i,:npts] = d[:npts]
+            data[i,npts:] = np.nan
+    data.flush()
+    np.save(store+'_index.npy',index)
+    return index,data
+
+def loadSpectralStore(store):
+    # Open a store written by ingestSpectralData without reading it into memory
+    index = np.load(store+'_index.npy')
+    data = np.load(store+'.npy',mmap_mode='r')
+    return index,data
+
+def selectSpectra(index,data,location=None,panel=None,sample=None,start=None,end=None):
+    # Pick spectra out of a store by metadata. start and end may be anything
+    # np.datetime64 understands (e.g. '2016-10-11' or '2016-10-11T12:00').
+    # Only the selected rows are read from disk.
+    mask = np.ones(index.shape[0],dtype=bool)
+    if location is not None:
+        mask &= index['location'] == location
+    if panel is not None:
+        mask &= index['panel'] == int(panel)
+    if sample is not None:
+        mask &= index['sample'] == int(sample)
+    if start is not None:
+        mask &= index['date'] >= np.datetime64(start)
+    if end is not None:
+        mask &= index['date'] <= np.datetime64(end)
+    rows = np.nonzero(mask)[0]
+    return index[rows],np.asarray(data[rows])
+
+def plotSpectralData(fmin,fmax,npts,data,filename=None,figsize=(8,6),window=None,smoothing='boxcar'):
+    import matplotlib.pyplot as plt
     plt.figure(figsize=figsize)
     fvals = np.linspace(fmax,fmin,npts)
     plt.plot(fvals,data,'r')
     if window is not None:
-        fwin,dwin = movingWindow(fvals,data,window)
+        fwin,dwin = smooth(fvals,data,window,kind=smoothing)
         plt.plot(fwin,dwin,'k--')
     plt.xlim(fmax,fmin)
     plt.xlabel('Wavenumber (cm${}^{-1}$)')
     plt.ylabel('Reflectance (%)')
     if filename is not None:
-        a,b = filename.split('_')
-        info = re.match(r'(\d+[a-z]{3})(?P<location>.*?)panel(?P<panel>\d?)s(?P<sample>\d+)',a)
-        experimentDate = datetime.datetime.strptime(b.replace('.asp',''),'%Y-%m-%dT%H-%M-%S')
+        location,panel,sample,experimentDate = parseSpectralFilename(filename)
         plt.text(0.1,0.9,experimentDate.strftime('Recorded: %a, %d %b %Y at %X'),transform=plt.gca().transAxes)
-        plt.text(0.1,0.85,"Location: %s   Panel: %s   Sample: %s"%(info.group('location'), 
-                                                              info.group('panel'), 
-                                                              info.group('sample')),transform=plt.gca().transAxes)
+        plt.text(0.1,0.85,"Location: %s   Panel: %s   Sample: %s"%(location,panel,sample),transform=plt.gca().transAxes)
         plt.text(0.1,0.8,"Filename: "+filename,transform=plt.gca().transAxes)
     plt.show()
 
-def cutPortion(fmin,fmax,npts,data,low_cut,high_cut):
+def _openRange(f,low,high):
+    # Slice of the points of a monotonic array f with low < f < high
+    if f[0] > f[-1]:
+        return slice(f.shape[0]-np.searchsorted(f[::-1],high,side='left'),
+                     f.shape[0]-np.searchsorted(f[::-1],low,side='right'))
+    return slice(np.searchsorted(f,low,side='right'),np.searchsorted(f,high,side='left'))
+
+def cutPortion(fmin,fmax,npts,data,low_cut,high_cut,plot=True):
     fvals = np.linspace(fmax,fmin,npts)
     
-    x = fvals[(fvals>low_cut)&(fvals<high_cut)]
-    y = data[(fvals>low_cut)&(fvals<high_cut)]
+    cut = _openRange(fvals,low_cut,high_cut)
+    x = fvals[cut]
+    y = data[cut]
     
-    plt.plot(x,y)
+    if plot:
+        import matplotlib.pyplot as plt
+        plt.plot(x,y)
     
     return x, y
     
-def fitBackground(x,y,roi):
+def fitBackground(x,y,roi,plot=True):
     
     x1 = x[(x>roi[0])&(x<roi[1])]
     y1 = y[(x>roi[0])&(x<roi[1])]
@@ -62,29 +187,53 @@ def fitBackground(x,y,roi):
 
     p = np.polyfit(x_bas,y_bas,1)
 
-    plt.figure()
-    plt.plot(x,y,"k.",label="signal")
-    plt.plot(x_bas,y_bas,"b.",label="anchors for fit")
-    plt.plot(x,np.polyval(p,x),"r-",label="baseline")
-    plt.legend()
+    if plot:
+        import matplotlib.pyplot as plt
+        plt.figure()
+        plt.plot(x,y,"k.",label="signal")
+        plt.plot(x_bas,y_bas,"b.",label="anchors for fit")
+        plt.plot(x,np.polyval(p,x),"r-",label="baseline")
+        plt.legend()
     return np.polyval(p,x)
 
-def fitSignal(x,y):
-    
-    def gaussian(x,a,b,c):
-        return a*np.exp(-0.5*((b-x)**2/(c**2)))
+def gaussian(x,a,b,c):
+    return a*np.exp(-0.5*((b-x)**2/(c**2)))
 
-    def lorentzian(x,a,b,c):
-        return a/(1+((b-x)**2/(c**2)))
+def lorentzian(x,a,b,c):
+    return a/(1+((b-x)**2/(c**2)))
 
-    def model(x,a1,p1,w1,a2,p2,w2,a3,p3,w3):
-        return gaussian(x,a1,p1,w1) + gaussian(x,a2,p2,w2) + lorentzian(x,a3,p3,w3)
-    
-    p_init = np.array([0.5,1420.,30.,1.5,1550.,50.,3.0,1650.,30])    
+def peakModel(x,a1,p1,w1,a2,p2,w2,a3,p3,w3):
+    # Two Gaussians and a Lorentzian
+    return gaussian(x,a1,p1,w1) + gaussian(x,a2,p2,w2) + lorentzian(x,a3,p3,w3)
+
+def peakModelJacobian(x,a1,p1,w1,a2,p2,w2,a3,p3,w3):
+    # Analytic derivatives of peakModel, shape (len(x), 9)
+    jac = np.empty((x.shape[0],9))
+    for k,(a,b,c) in enumerate(((a1,p1,w1),(a2,p2,w2))):
+        e = np.exp(-0.5*((b-x)**2/(c**2)))
+        jac[:,3*k] = e
+        jac[:,3*k+1] = -a*e*(b-x)/c**2
+        jac[:,3*k+2] = a*e*(b-x)**2/c**3
+    l = 1/(1+((p3-x)**2/(w3**2)))
+    jac[:,6] = l
+    jac[:,7] = -2*a3*l**2*(p3-x)/w3**2
+    jac[:,8] = 2*a3*l**2*(p3-x)**2/w3**3
+    return jac
+
+P_INIT = np.array([0.5,1420.,30.,1.5,1550.,50.,3.0,1650.,30])
 
-    p_opt, p_cov = curve_fit(model,x,y,p0=p_init)
+def fitSignal(x,y,p_init=None):
+    # Fit and plot; fitSignals does the same fits without plotting
+    import matplotlib.pyplot as plt
+    if p_init is None:
+        p_init = P_INIT
 
-    y_calc = model(x,*p_opt)
+    start = time.perf_counter()
+    p_opt, p_cov, info, msg, ier = curve_fit(peakModel,x,y,p0=p_init,jac=peakModelJacobian,full_output=True)
+    if CALLBACKS:
+        _report('fitSignal',start,evaluations=int(info['nfev']),iterations=int(info['njev']))
+
+    y_calc = peakModel(x,*p_opt)
 
     plt.plot(x,y,"k.",label="data")
     plt.plot(x,y_calc,"r-",label="model")
@@ -93,13 +242,157 @@ def fitSignal(x,y):
     plt.plot(x,lorentzian(x,p_opt[6],p_opt[7],p_opt[8]),"m-",label="Lorentzian 1")
     plt.legend()
 
-def trapz(x, y):
-    # Trapezoidal integration rule
-    n = len(x)
-    
-    r = 0.0
+FIT_RESULT = np.dtype([('params','f8',(9,)),('cov','f8',(9,9)),('success','?'),('nfev','i4')])
+
+def _fitOne(x,y,p0):
+    # Headless fit of peakModel; returns a FIT_RESULT record. A fit that does
+    # not converge, or a spectrum with NaN/inf in it (the padding in a spectral
+    # store), gives success=False rather than an exception.
+    out = np.zeros((),dtype=FIT_RESULT)
+    start = time.perf_counter()
+    try:
+        p_opt,p_cov,info,msg,ier = curve_fit(peakModel,x,y,p0=p0,jac=peakModelJacobian,full_output=True)
+        out[()] = (p_opt,p_cov,ier in (1,2,3,4) and np.all(np.isfinite(p_cov)),info['nfev'])
+        njev = int(info['njev'])
+    except (RuntimeError,ValueError):
+        out[()] = (np.nan,np.nan,False,0)
+        njev = 0
+    if CALLBACKS:
+        _report('_fitOne',start,evaluations=int(out['nfev']),iterations=njev)
+    return out
+
+def _fitChain(args):
+    # Fit a run of spectra in order, starting each fit from the previous solution
+    x,ys,p_init = args
+    out = np.zeros(ys.shape[0],dtype=FIT_RESULT)
+    p0 = p_init
+    for i,y in enumerate(ys):
+        out[i] = _fitOne(x,y,p0)
+        # Only pass on a solution we trust; a diverged fit would derail the rest of the chain
+        p0 = out[i]['params'] if out[i]['success'] else p_init
+    return out
+
+def fitSignals(x,ys,p_init=None,nprocs=None,chunksize=256):
+    # Fit peakModel to every row of ys without plotting. Rows are split into
+    # contiguous chunks that run in parallel; within a chunk each fit is
+    # warm-started from its neighbour's solution, so neighbouring spectra should
+    # be similar. Returns a structured array (see FIT_RESULT) with one record per row.
+    import multiprocessing
+    if p_init is None:
+        p_init = P_INIT
+    ys = np.atleast_2d(ys)
+    chunks = [(x,ys[i:i+chunksize],p_init) for i in range(0,ys.shape[0],chunksize)]
+    if len(chunks) == 1:
+        return _fitChain(chunks[0])
+    with multiprocessing.Pool(nprocs) as pool:
+        return np.concatenate(pool.map(_fitChain,chunks))
+
+class SpectralPipeline:
+    # cutPortion -> fitBackground -> fitSignal, set up once and then applied to
+    # any number of spectra sharing the same (fmin, fmax, npts) axis, with no plotting.
+    # The cut and baseline regions become index slices, and the linear baseline
+    # fit becomes a fixed projection matrix, so each spectrum costs only a few
+    # small matrix products (plus the peak fit, if fit=True).
+    #
+    #   pipe = SpectralPipeline(fmin,fmax,npts,(1350.,2000.),[1350.,1370.,1850.,1900.])
+    #   for y_corr,fit in pipe.run(spectra): ...
+    #
+    # sink, if given, is called as sink(x,y,baseline,fit) for every spectrum;
+    # plotSink reproduces the figures drawn by fitBackground and fitSignal.
+    def __init__(self,fmin,fmax,npts,cut,roi,p_init=None,fit=True,sink=None):
+        fvals = np.linspace(fmax,fmin,npts)
+        self.cut = _openRange(fvals,cut[0],cut[1])
+        self.x = fvals[self.cut]
+        r1 = _openRange(self.x,roi[0],roi[1])
+        r2 = _openRange(self.x,roi[2],roi[3])
+        self.anchors = np.r_[r1,r2]
+        self.design = np.vander(self.x,2)
+        self.projection = np.linalg.pinv(self.design[self.anchors])
+        self.p_init = P_INIT if p_init is None else p_init
+        self.fit = fit
+        self.sink = sink
+
+    def baseline(self,y):
+        # Linear baseline through the anchor regions, for one spectrum or a stack
+        return (y[...,self.anchors] @ self.projection.T) @ self.design.T
+
+    def correct(self,data):
+        # Cut and baseline-subtract one spectrum or a stack; returns (x, y_corr)
+        y = data[...,self.cut]
+        return self.x,y-self.baseline(y)
+
+    def run(self,spectra):
+        # Generator over (y_corr, fit) for each spectrum in an iterable (or the
+        # rows of a 2-D array). Each fit is warm-started from the last good one.
+        p0 = self.p_init
+        for data in spectra:
+            y = np.asarray(data)[self.cut]
+            baseline = self.baseline(y)
+            y_corr = y-baseline
+            fit = None
+            if self.fit:
+                fit = _fitOne(self.x,y_corr,p0)
+                p0 = fit['params'] if fit['success'] else self.p_init
+            if self.sink is not None:
+                self.sink(self.x,y,baseline,fit)
+            yield y_corr,fit
+
+def plotSink(x,y,baseline,fit):
+    # SpectralPipeline sink drawing the baseline and peak-fit figures
+    import matplotlib.pyplot as plt
+    plt.figure()
+    plt.plot(x,y,"k.",label="signal")
+    plt.plot(x,baseline,"r-",label="baseline")
+    plt.legend()
+    if fit is not None and fit['success']:
+        p_opt = fit['params']
+        y_corr = y-baseline
+        plt.figure()
+        plt.plot(x,y_corr,"k.",label="data")
+        plt.plot(x,peakModel(x,*p_opt),"r-",label="model")
+        plt.plot(x,gaussian(x,p_opt[0],p_opt[1],p_opt[2]),"b-",label="Gaussian 1")
+        plt.plot(x,gaussian(x,p_opt[3],p_opt[4],p_opt[5]),"b-",label="Gaussian 2")
+        plt.plot(x,lorentzian(x,p_opt[6],p_opt[7],p_opt[8]),"m-",label="Lorentzian 1")
+        plt.legend()
+    plt.show()
+
+def trapz(x, y, axis=-1):
+    # Trapezoidal integration rule, along `axis` of y. x is either 1-D (shared by
+    # every spectrum) or the same shape as y.
+    x = np.asarray(x, dtype=float)
+    y = np.moveaxis(np.asarray(y, dtype=float), axis, -1)
+    if x.ndim > 1:
+        x = np.moveaxis(x, axis, -1)
+    trapz_int = np.sum(np.diff(x, axis=-1) * (y[..., 1:] + y[..., :-1]), axis=-1) / 2.0
+    return trapz_int
+
+def cumtrapz(x, y, axis=-1):
+    # Running trapezoidal integral along `axis`, starting from 0 at the first point,
+    # so the result has the same shape as y and its last value equals trapz(x, y).
+    x = np.asarray(x, dtype=float)
+    y = np.moveaxis(np.asarray(y, dtype=float), axis, -1)
+    if x.ndim > 1:
+        x = np.moveaxis(x, axis, -1)
+    c = np.zeros(y.shape)
+    np.cumsum(np.diff(x, axis=-1) * (y[..., 1:] + y[..., :-1]) / 2.0, axis=-1, out=c[..., 1:])
+    return np.moveaxis(c, -1, axis)
 
-    for i in range(1,n):
-        r += (x[i] - x[i-1]) * (y[i] + y[i-1])
-    trapz_int = r/2.0
-    return trapz_int
\ No newline at end of file
+def bandAreas(x, y, bands):
+    # Areas under y between each (low, high) pair in bands, for a 1-D x shared by
+    # a single spectrum or a 2-D stack (one per row). Returns shape y.shape[:-1] + (nbands,).
+    # One cumulative integral is built per spectrum; each band is then the difference
+    # of that integral at its two edges, with the partial trapezoid at each edge
+    # interpolated linearly. Edges outside the range of x are clipped to it.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if x[0] > x[-1]:
+        # Wavenumbers are usually stored high to low
+        x = x[::-1]
+        y = y[..., ::-1]
+    c = cumtrapz(x, y)
+    edges = np.clip(np.asarray(bands, dtype=float), x[0], x[-1])
+    k = np.clip(np.searchsorted(x, edges, side='right') - 1, 0, x.shape[0] - 2)
+    frac = (edges - x[k]) / (x[k+1] - x[k])
+    ye = y[..., k] + frac * (y[..., k+1] - y[..., k])
+    ce = c[..., k] + (edges - x[k]) * (y[..., k] + ye) / 2.0
+    return ce[..., 1] - ce[..., 0]
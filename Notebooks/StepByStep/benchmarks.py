@@ -0,0 +1,281 @@
+# Timing baselines for the computational kernels in the StepByStep modules.
+#
+#   python benchmarks.py --output results.json
+#   python benchmarks.py --baseline results.json --threshold 0.25
+#
+# Every kernel is timed at several problem sizes and the results are written
+# as JSON. Given a saved baseline, any kernel that got slower by more than the
+# threshold (as a fraction of its baseline time) is reported, and the exit
+# status is 1. Runs headless: matplotlib is forced onto the Agg backend and
+# any figures the kernels draw are closed straight away.
+import os
+os.environ.setdefault('MPLBACKEND','Agg')
+import sys
+import io
+import json
+import time
+import timeit
+import argparse
+import platform
+import contextlib
+import importlib.util
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+MODULES = {'pendulum':'Ex19/pendulum.py',
+           'spectroscopy':'ExNS/spectroscopy.py',
+           'radioactiveDecay':'Ex13/radioactiveDecay.py',
+           'sealevel':'Ex17/sealevel.py',
+           'rotations':'Ex11/rotations.py',
+           'sudoku_solver':'Ex11/sudoku_solver.py',
+           'caesar':'Ex07/caesar.py',
+           'sorting':'Ex20/sorting.py'}
+
+def load(name):
+    # Import one of the exercise modules by path (they are not a package).
+    # The module is registered under its own name so that process pools
+    # started from it can find their workers again.
+    if name not in sys.modules:
+        path = os.path.join(HERE,MODULES[name])
+        spec = importlib.util.spec_from_file_location(name,path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        sys.path.insert(0,os.path.dirname(path))
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[name]
+            raise
+    return sys.modules[name]
+
+def _closeFigures():
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
+
+# Each benchmark maps a problem size n to a function taking no arguments that
+# runs the kernel once; anything that should not be timed (building inputs)
+# happens before that function is returned.
+BENCHMARKS = {}
+
+def benchmark(name,sizes):
+    def register(setup):
+        BENCHMARKS[name] = (tuple(sizes),setup)
+        return setup
+    return register
+
+@benchmark('pendulum.simplePendulumIntegration',[500,5000,50000])
+def _simplePendulum(n):
+    pendulum = load('pendulum')
+    t = np.linspace(0,10,n)
+    return lambda: pendulum.simplePendulumIntegration(timesteps=t)
+
+@benchmark('pendulum.doublePendulumIntegration',[500,5000,50000])
+def _doublePendulum(n):
+    pendulum = load('pendulum')
+    t = np.linspace(0,10,n)
+    return lambda: pendulum.doublePendulumIntegration(timesteps=t)
+
+def _spectrum(n,rng):
+    spectroscopy = load('spectroscopy')
+    x = np.linspace(1350.,2000.,n)
+    y = spectroscopy.peakModel(x,*spectroscopy.P_INIT)
+    return x,y+0.05*rng.standard_normal(n)
+
+@benchmark('spectroscopy.movingWindow',[1000,100000,1000000])
+def _movingWindow(n):
+    spectroscopy = load('spectroscopy')
+    x,y = _spectrum(n,np.random.default_rng(0))
+    return lambda: spectroscopy.movingWindow(x,y,10)
+
+@benchmark('spectroscopy.trapz',[1000,100000,1000000])
+def _trapz(n):
+    spectroscopy = load('spectroscopy')
+    x,y = _spectrum(n,np.random.default_rng(0))
+    return lambda: spectroscopy.trapz(x,y)
+
+@benchmark('spectroscopy.fitSignal',[200,2000,20000])
+def _fitSignal(n):
+    spectroscopy = load('spectroscopy')
+    x,y = _spectrum(n,np.random.default_rng(0))
+    def run():
+        spectroscopy.fitSignal(x,y)
+        _closeFigures()
+    return run
+
+@benchmark('radioactiveDecay.simulateDecay',[1000,100000,1000000])
+def _simulateDecay(n):
+    radioactiveDecay = load('radioactiveDecay')
+    return lambda: radioactiveDecay.simulateDecay(3600./n,n)
+
+@benchmark('radioactiveDecay.calculateAge',[1000,100000,1000000])
+def _calculateAge(n):
+    radioactiveDecay = load('radioactiveDecay')
+    t,counts,_ = radioactiveDecay.simulateDecay(3600./n,n)
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            radioactiveDecay.calculateAge(t,counts,2.)
+    return run
+
+def _rslData(n,rng):
+    # A synthetic record shaped like RSL_data.xlsx: irregular ages in kaBP
+    # with a few orbital-period cycles in sea level
+    sealevel = load('sealevel')
+    age = np.sort(rng.uniform(0.,500.,n))
+    rsl = (-60+40*np.sin(2*np.pi*age/100.)+10*np.sin(2*np.pi*age/41.)
+           +5*np.sin(2*np.pi*age/23.)+rng.standard_normal(n))
+    return sealevel.RSLData({'Age_kaBP':age,'RSL_m':rsl})
+
+@benchmark('sealevel.interpolate_data',[4096,65536,1048576])
+def _interpolate(n):
+    sealevel = load('sealevel')
+    data = _rslData(n,np.random.default_rng(0))
+    return lambda: sealevel.interpolate_data(data,n)
+
+@benchmark('sealevel.rfft',[4096,32768,262144])
+def _rfft(n):
+    # Interpolation plus the padded forward transform, then one band-pass
+    # filter applied and transformed back
+    sealevel = load('sealevel')
+    data = _rslData(4096,np.random.default_rng(0))
+    def run():
+        sa = sealevel.SpectralAnalysis(data,ninterp=n)
+        sa.apply(lambda f: sealevel.gaussianBandPass(f,1/41.,0.002))
+    return run
+
+@benchmark('rotations.rotation_list',[10,100,1000])
+def _rotationList(n):
+    rotations = load('rotations')
+    rng = np.random.default_rng(0)
+    rots = list(zip(rng.choice(['x','y','z'],n),rng.uniform(0.,360.,n)))
+    return lambda: rotations.rotation_list(rots)
+
+SUDOKUS = ['003020600900305001001806400008102900700000008006708200002609500800203009005010300',
+           '800000000003600000070090000050007000000045700000100030001000068068000000000000000',
+           '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......',
+           '.....6....59.....82....8....45........3........6..3.54...325..6..................']
+
+def _sudokus(n,rng,puzzles=SUDOKUS):
+    # n puzzles made from the given ones by relabelling the digits at random
+    base = np.array([[0 if ch == '.' else int(ch) for ch in s] for s in puzzles])
+    puzzles = base[np.arange(n)%len(base)]
+    relabel = np.argsort(rng.random((n,9)),axis=1)+1
+    relabel = np.concatenate([np.zeros((n,1),dtype=int),relabel],axis=1)
+    return np.take_along_axis(relabel,puzzles,axis=1).reshape(n,9,9)
+
+@benchmark('sudoku_solver.sudoku_solver',[1,4,16])
+def _sudoku(n):
+    sudoku_solver = load('sudoku_solver')
+    puzzles = _sudokus(n,np.random.default_rng(0))
+    def run():
+        for p in puzzles:
+            sudoku_solver.sudoku_solver(p.copy())
+    return run
+
+@benchmark('sudoku_solver.sudoku_solver_batch',[100,1000,10000])
+def _sudokuBatch(n):
+    # Mostly puzzles that propagation alone solves, as in a generator's
+    # output, with one in a hundred needing search. Single process, so that
+    # the timing does not depend on the core count.
+    sudoku_solver = load('sudoku_solver')
+    puzzles = _sudokus(n,np.random.default_rng(0),SUDOKUS[:1]*99+SUDOKUS[1:2])
+    return lambda: sudoku_solver.sudoku_solver_batch(puzzles.copy(),nprocs=1)
+
+@benchmark('caesar.caesar',[1000,100000,10000000])
+def _caesar(n):
+    caesar = load('caesar')
+    words = 'the quick brown fox jumps over the lazy dog, '
+    msg = (words*(n//len(words)+1))[:n]
+    return lambda: caesar.caesar(msg,7)
+
+_SORT_SIZES = {'gnome':[100,1000],'bubble':[100,1000],'selection':[100,1000],'shell':[100,1000],
+               'merge':[1000,10000,50000],'quick':[1000,10000,50000],
+               'heap':[1000,10000,50000],'intro':[1000,10000,50000]}
+
+def _sortBenchmark(name):
+    def setup(n):
+        sorting = load('sorting')
+        a = sorting.makeInput('random',n,np.random.default_rng(0))
+        return lambda: sorting.SORTS[name](a.copy(),record=False)
+    return setup
+
+for _name,_sizes in _SORT_SIZES.items():
+    benchmark('sorting.%sSort'%_name,_sizes)(_sortBenchmark(_name))
+
+def timeKernel(run,repeat=5,mintime=0.2):
+    # Best time per call over repeat rounds, each round running the kernel
+    # enough times to last at least mintime seconds (as timeit does)
+    timer = timeit.Timer(run)
+    number = 1
+    while True:
+        t = timer.timeit(number)
+        if t >= mintime:
+            break
+        number = max(number*2,int(number*1.2*mintime/max(t,1e-9)))
+    times = [t]+timer.repeat(repeat-1,number)
+    return min(times)/number,number
+
+def runBenchmarks(names=None,repeat=5,mintime=0.2,verbose=True):
+    # Time the named benchmarks (all of them by default); names may also be
+    # prefixes such as 'sorting.' or 'spectroscopy.'. Returns the JSON-ready
+    # results: machine details and a list of {name, n, time, number} records.
+    if names is None:
+        selected = list(BENCHMARKS)
+    else:
+        selected = [b for b in BENCHMARKS if any(b == s or b.startswith(s) for s in names)]
+    records = []
+    for name in selected:
+        sizes,setup = BENCHMARKS[name]
+        for n in sizes:
+            t,number = timeKernel(setup(n),repeat,mintime)
+            records.append({'name':name,'n':n,'time':t,'number':number})
+            if verbose:
+                print('%-40s n=%-9i %12.6f s'%(name,n,t),flush=True)
+    return {'python':platform.python_version(),'numpy':np.__version__,
+            'machine':platform.machine(),'processor':platform.processor(),
+            'created':time.strftime('%Y-%m-%dT%H:%M:%S'),'results':records}
+
+def compare(results,baseline,threshold=0.25):
+    # Kernels slower than their baseline time by more than threshold (0.25 is
+    # 25% slower). Only (name, n) pairs present in both are compared. Returns
+    # a list of {name, n, time, baseline, ratio} records, worst first.
+    previous = {(r['name'],r['n']):r['time'] for r in baseline['results']}
+    regressions = []
+    for r in results['results']:
+        key = (r['name'],r['n'])
+        if key in previous and r['time'] > (1+threshold)*previous[key]:
+            regressions.append({'name':r['name'],'n':r['n'],'time':r['time'],
+                                'baseline':previous[key],'ratio':r['time']/previous[key]})
+    return sorted(regressions,key=lambda r: -r['ratio'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the StepByStep computational kernels')
+    parser.add_argument('names',nargs='*',help='benchmarks to run, by name or prefix (default: all)')
+    parser.add_argument('--output','-o',help='write the results to this JSON file')
+    parser.add_argument('--baseline','-b',help='compare against the results in this JSON file')
+    parser.add_argument('--threshold','-t',type=float,default=0.25,
+                        help='allowed slowdown against the baseline, as a fraction (default 0.25)')
+    parser.add_argument('--repeat',type=int,default=5,help='timing rounds per kernel (default 5)')
+    parser.add_argument('--list',action='store_true',help='list the benchmarks and exit')
+    args = parser.parse_args(argv)
+    if args.list:
+        for name,(sizes,_) in BENCHMARKS.items():
+            print('%-40s %s'%(name,', '.join(str(n) for n in sizes)))
+        return 0
+    results = runBenchmarks(args.names or None,repeat=args.repeat)
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(results,f,indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results,baseline,args.threshold)
+        for r in regressions:
+            print('REGRESSION %-40s n=%-9i %.6f s vs %.6f s (x%.2f)'%(
+                r['name'],r['n'],r['time'],r['baseline'],r['ratio']))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+# Opt-in counters for the solver and fitter hot paths.
+#
+#   import instrumentation, pendulum, sudoku_solver
+#   with instrumentation.Recorder(pendulum,sudoku_solver) as rec:
+#       pendulum.doublePendulumIntegration()
+#       sudoku_solver.sudoku_solver(grid)
+#   rec.summary()          # totals per function
+#   rec.save('calls.json')
+#
+# An instrumented module keeps a CALLBACKS list. While it is empty (the
+# default) its functions only pay for one timer read and an empty-list test.
+# A Recorder adds itself to the list of each module it is given for the
+# duration of the with block. Every call then yields a record with the
+# function name, calls (always 1), wall time in seconds, and two counts:
+#
+#   function                     evaluations                 iterations
+#   simplePendulumIntegration    RHS evaluations             odeint steps
+#   doublePendulumIntegration    RHS evaluations             odeint steps
+#   fitSignal, _fitOne           model evaluations           Jacobian evaluations
+#   sudoku_solver                guesses made in the search  propagation passes
+#
+# _fitOne does the fits for SpectralPipeline and fitSignals. Calls made in
+# pool workers (fitSignals or sudoku_solver_batch with several processes)
+# happen in other processes and are not recorded.
+import json
+import numpy as np
+
+RECORD = np.dtype([('function','U32'),('calls','i8'),('evaluations','i8'),
+                   ('iterations','i8'),('time','f8')])
+
+class Recorder:
+    def __init__(self,*modules):
+        self.modules = modules
+        self.records = []
+
+    def __call__(self,record):
+        self.records.append(record)
+
+    def __enter__(self):
+        for module in self.modules:
+            module.CALLBACKS.append(self)
+        return self
+
+    def __exit__(self,*exc):
+        for module in self.modules:
+            module.CALLBACKS.remove(self)
+        return False
+
+    def clear(self):
+        self.records = []
+
+    def to_array(self):
+        # Every record, in call order, as a RECORD structured array
+        # (-1 for a count the function does not report)
+        out = np.zeros(len(self.records),dtype=RECORD)
+        for i,r in enumerate(self.records):
+            out[i] = (r['function'],r['calls'],r.get('evaluations',-1),
+                      r.get('iterations',-1),r['time'])
+        return out
+
+    def summary(self):
+        # One RECORD per function, in order of first call, with calls, counts
+        # and time summed over all of its calls
+        records = self.to_array()
+        names = list(dict.fromkeys(records['function']))
+        out = np.zeros(len(names),dtype=RECORD)
+        for i,name in enumerate(names):
+            rs = records[records['function'] == name]
+            out[i] = (name,rs['calls'].sum(),rs['evaluations'].sum(),
+                      rs['iterations'].sum(),rs['time'].sum())
+        return out
+
+    def save(self,filename):
+        # Write the records, one JSON object per call
+        with open(filename,'w') as f:
+            json.dump(self.records,f,indent=1)